@@ -1,13 +1,15 @@
+import argparse
 import os
+import random
+import sys
 
-SIDES = ('N', 'S')
-SECTORS = 12
-TILES = 32
-IB = 6
-CHANNELS = 64
+from mapping_index import MappingIndex, SECTORS, TILES, N_TILES, UNMAPPED, tile_index
+from trim_map import TrimMap, SIDES
 
 OFF = -2200
 ON = 2200
+# Board bias voltage written to the pattern files
+BIAS = 55
 
 def load_mapping(file: str) -> dict:
     '''
@@ -19,213 +21,128 @@ def load_mapping(file: str) -> dict:
     Returns:
         dict: Dictionary containing the mapping information
     '''
+    return MappingIndex.load(file).to_dict()
 
-    mapping = {}
-    with open(file, 'r') as f:
-        next(f)  # Skip the first line of the file
-        for line in f:
-            side, sector,tile, _, _, _, ib, channel = line.strip().split(',')
-            side = side.strip().upper()
-            sector = int(sector.strip())
-            tile = int(tile.strip())
-            ib = int(ib.strip())
-            channel = int(channel.strip())
-            if side == 'S':
-                ib -= 6
-            if side not in mapping:
-                mapping[side] = {}
-            if sector not in mapping[side]:
-                mapping[side][sector] = {}
-            if tile not in mapping[side][sector]:
-                mapping[side][sector][tile] = (side, int(ib), int(channel))
-
-    return mapping
-
-def make_pattern(pattern: int, mapping: dict) -> tuple:
+def select(predicate) -> int:
     '''
-    Generate the pattern
+    Build a pattern mask from a predicate over (side, sector, tile).
 
     Parameters:
-        pattern (int): Pattern number
-        mapping (dict): Dictionary containing the mapping information
+        predicate (callable): Called with side, sector and tile, true for
+                              tiles in the mask
 
     Returns:
-        list: List containing the pattern information
+        int: Mask with bit tile_index(side, sector, tile) set for every
+             selected tile
     '''
-    trim = {}
-    for side in SIDES:
-        trim[side] = {}
-        for ib in range (IB):
-            trim[side][ib] = {}
-            for channel in range(CHANNELS):
-                trim[side][ib][channel] = 0
-
-    trim_check = {}
+    mask = 0
     for side in SIDES:
-        trim_check[side] = {}
-        for sector in range (SECTORS):
-            trim_check[side][sector] = {}
+        for sector in range(SECTORS):
             for tile in range(TILES):
-                trim_check[side][sector][tile] = 0
-
-    # All off
-    if pattern == 1:
-        for side in SIDES:
-            for sector in range (SECTORS):
-                for tile in range(TILES):
-                    side, ib, channel = mapping[side][sector][tile]
-                    trim[side][ib][channel] = OFF
-                    trim_check[side][sector][tile] = OFF
-
-    # All on
-    if pattern == 2:
-        for side in SIDES:
-            for sector in range (SECTORS):
-                for tile in range(TILES):
-                    side, ib, channel = mapping[side][sector][tile]
-                    trim[side][ib][channel] = ON
-                    trim_check[side][sector][tile] = ON
-
-    # North off, south on
-    if pattern == 3:
-        for side in SIDES:
-            for sector in range (SECTORS):
-                for tile in range(TILES):
-                    if side == 'N':
-                        side, ib, channel = mapping[side][sector][tile]
-                        trim[side][ib][channel] = OFF
-                        trim_check[side][sector][tile] = OFF
-                    else:
-                        side, ib, channel = mapping[side][sector][tile]
-                        trim[side][ib][channel] = ON
-                        trim_check[side][sector][tile] = ON
+                if predicate(side, sector, tile):
+                    mask |= 1 << tile_index(side, sector, tile)
+    return mask
+
+ALL_TILES = (1 << N_TILES) - 1
+
+# Masks of the tiles whose side, sector or tile index has a given bit set.
+# Patterns are bit expressions over these.
+SIDE_BIT = select(lambda side, sector, tile: side == 'S')
+SECTOR_BITS = [select(lambda side, sector, tile, b=b: sector >> b & 1) for b in range((SECTORS - 1).bit_length())]
+TILE_BITS = [select(lambda side, sector, tile, b=b: tile >> b & 1) for b in range((TILES - 1).bit_length())]
+
+# The twelve check patterns, as the mask of tiles that are turned off.
+# All other tiles are turned on.
+PATTERNS = {
+    1: ALL_TILES,                                                       # All off
+    2: 0,                                                               # All on
+    3: ALL_TILES & ~SIDE_BIT,                                           # North off, south on
+    4: ALL_TILES & ~SECTOR_BITS[0],                                     # Even sectors off, odd on
+    5: select(lambda side, sector, tile: sector < 6),                   # Sectors 0-5 off, 6-11 on
+    6: select(lambda side, sector, tile: sector % 6 in (0, 1)),         # Sectors 0, 1, 6 and 7 off, rest on
+    7: select(lambda side, sector, tile: sector % 6 in (2, 3)),         # Sectors 2, 3, 8 and 9 off, rest on
+    8: ALL_TILES & ~TILE_BITS[0],                                       # Even tiles off, odd on
+    9: ALL_TILES & ~TILE_BITS[4],                                       # Tiles 0-15 off, 16-31 on
+    10: ALL_TILES & ~TILE_BITS[3],                                      # Tiles 0-7 and 16-23 off, rest on
+    11: ALL_TILES & ~TILE_BITS[2],                                      # Alternating blocks of 4 tiles, starting off
+    12: ALL_TILES & ~TILE_BITS[1],                                      # Alternating blocks of 2 tiles, starting off
+}
+
+def bit_plane_patterns() -> dict:
+    '''
+    Generate a pattern for every bit of the side, sector and tile indices,
+    and its complement
 
-    # Odd sectors off, even on
-    if pattern == 4:
-        for side in SIDES:
-            for sector in range (SECTORS):
-                for tile in range(TILES):
-                    if sector % 2 == 0:
-                        side, ib, channel = mapping[side][sector][tile]
-                        trim[side][ib][channel] = OFF
-                        trim_check[side][sector][tile] = OFF
-                    else:
-                        side, ib, channel = mapping[side][sector][tile]
-                        trim[side][ib][channel] = ON
-                        trim_check[side][sector][tile] = ON
+    Returns:
+        dict: Pattern masks keyed by name
+    '''
+    planes = {'side': SIDE_BIT}
+    planes.update({f'sector_bit{b}': mask for b, mask in enumerate(SECTOR_BITS)})
+    planes.update({f'tile_bit{b}': mask for b, mask in enumerate(TILE_BITS)})
+    patterns = {}
+    for name, mask in planes.items():
+        patterns[f'{name}_off'] = mask
+        patterns[f'{name}_on'] = ALL_TILES & ~mask
+    return patterns
+
+def random_patterns(count: int, seed: int = None) -> dict:
+    '''
+    Generate random patterns with every tile independently on or off
 
-    # Sectors 1-6 off, 7-12 on
-    if pattern == 5:
-        for side in SIDES:
-            for sector in range (SECTORS):
-                for tile in range(TILES):
-                    if sector < 6:
-                        side, ib, channel = mapping[side][sector][tile]
-                        trim[side][ib][channel] = OFF
-                        trim_check[side][sector][tile] = OFF
-                    else:
-                        side, ib, channel = mapping[side][sector][tile]
-                        trim[side][ib][channel] = ON
-                        trim_check[side][sector][tile] = ON
-    
-    # Sectors 0, 1, 6, and 7 off, rest on
-    if pattern == 6:
-        for side in SIDES:
-            for sector in range (SECTORS):
-                for tile in range(TILES):
-                    if sector in [0, 1, 6, 7]:
-                        side, ib, channel = mapping[side][sector][tile]
-                        trim[side][ib][channel] = OFF
-                        trim_check[side][sector][tile] = OFF
-                    else:
-                        side, ib, channel = mapping[side][sector][tile]
-                        trim[side][ib][channel] = ON
-                        trim_check[side][sector][tile] = ON
+    Parameters:
+        count (int): Number of patterns
+        seed (int): Seed for the random number generator
 
-    # Sectors 2, 3, 8, 9 off, rest on
-    if pattern == 7:
-        for side in SIDES:
-            for sector in range (SECTORS):
-                for tile in range(TILES):
-                    if sector in [2, 3, 8, 9]:
-                        side, ib, channel = mapping[side][sector][tile]
-                        trim[side][ib][channel] = OFF
-                        trim_check[side][sector][tile] = OFF
-                    else:
-                        side, ib, channel = mapping[side][sector][tile]
-                        trim[side][ib][channel] = ON
-                        trim_check[side][sector][tile] = ON
+    Returns:
+        dict: Pattern masks keyed by name
+    '''
+    rng = random.Random(seed)
+    return {f'random_{n}': rng.getrandbits(N_TILES) for n in range(count)}
 
-    # Odd tiles off, even on
-    if pattern == 8:
-        for side in SIDES:
-            for sector in range (SECTORS):
-                for tile in range(TILES):
-                    if tile % 2 == 0:
-                        side, ib, channel = mapping[side][sector][tile]
-                        trim[side][ib][channel] = OFF
-                        trim_check[side][sector][tile] = OFF
-                    else:
-                        side, ib, channel = mapping[side][sector][tile]
-                        trim[side][ib][channel] = ON
-                        trim_check[side][sector][tile] = ON
+def channel_order(mapping) -> list:
+    '''
+    Flatten the mapping into the trim index of every tile
 
-    # Tiles 0-15 off, 16-31 on
-    if pattern == 9:
-        for side in SIDES:
-            for sector in range (SECTORS):
-                for tile in range(TILES):
-                    if tile < 16:
-                        side, ib, channel = mapping[side][sector][tile]
-                        trim[side][ib][channel] = OFF
-                        trim_check[side][sector][tile] = OFF
-                    else:
-                        side, ib, channel = mapping[side][sector][tile]
-                        trim[side][ib][channel] = ON
-                        trim_check[side][sector][tile] = ON
+    Parameters:
+        mapping (MappingIndex or dict): The mapping
 
-    # Tiles 0-7 off, 8-15 on, 16-23 off, 24-31 on
-    if pattern == 10:
-        for side in SIDES:
-            for sector in range (SECTORS):
-                for tile in range(TILES):
-                    if tile in range(8) or tile in range(16, 24):
-                        side, ib, channel = mapping[side][sector][tile]
-                        trim[side][ib][channel] = OFF
-                        trim_check[side][sector][tile] = OFF
-                    else:
-                        side, ib, channel = mapping[side][sector][tile]
-                        trim[side][ib][channel] = ON
-                        trim_check[side][sector][tile] = ON
+    Returns:
+        list: TrimMap index of each tile, ordered by tile_index
+    '''
+    if isinstance(mapping, MappingIndex):
+        return list(mapping.forward)
+    order = []
+    for side in SIDES:
+        for sector in range(SECTORS):
+            for tile in range(TILES):
+                order.append(TrimMap.index(*mapping[side][sector][tile]))
+    return order
 
-    # tiles 0-3 off, 4-7 on, 8-11 off, 12-15 on, 16-19 off, 20-23 on, 24-27 off, 28-31 on
-    if pattern == 11:
-        for side in SIDES:
-            for sector in range (SECTORS):
-                for tile in range(TILES):
-                    if tile in range(4) or tile in range(8, 12) or tile in range(16, 20) or tile in range(24, 28):
-                        side, ib, channel = mapping[side][sector][tile]
-                        trim[side][ib][channel] = OFF
-                        trim_check[side][sector][tile] = OFF
-                    else:
-                        side, ib, channel = mapping[side][sector][tile]
-                        trim[side][ib][channel] = ON
-                        trim_check[side][sector][tile] = ON
+def make_pattern(pattern, mapping) -> tuple:
+    '''
+    Generate the pattern
 
-    # tiles 0-1 off, 2-3 on, 4-5 off, 6-7 on, 8-9 off, 10-11 on, 12-13 off, 14-15 on, 16-17 off, 18-19 on, 20-21 off, 22-23 on, 24-25 off, 26-27 on, 28-29 off, 30-31 on
-    if pattern == 12:
-        for side in SIDES:
-            for sector in range (SECTORS):
-                for tile in range(TILES):
-                    if tile in range(2) or tile in range(4, 6) or tile in range(8, 10) or tile in range(12, 14) or tile in range(16, 18) or tile in range(20, 22) or tile in range(24, 26) or tile in range(28, 30):
-                        side, ib, channel = mapping[side][sector][tile]
-                        trim[side][ib][channel] = OFF
-                        trim_check[side][sector][tile] = OFF
-                    else:
-                        side, ib, channel = mapping[side][sector][tile]
-                        trim[side][ib][channel] = ON
-                        trim_check[side][sector][tile] = ON
+    Parameters:
+        pattern (int): Pattern number from PATTERNS, or a pattern mask
+        mapping (MappingIndex, dict or list): The mapping, or the output of
+                                              channel_order
 
+    Returns:
+        tuple: TrimMap with the trims, and the expected trim of every tile
+               ordered by tile_index
+    '''
+    if not isinstance(mapping, list):
+        mapping = channel_order(mapping)
+    mask = PATTERNS[pattern] if isinstance(pattern, int) and pattern in PATTERNS else pattern
+
+    # One pass over the mask bits, lowest tile first
+    bits = bin(mask & ALL_TILES)[2:].zfill(N_TILES)[::-1]
+    trim_check = [OFF if bit == '1' else ON for bit in bits]
+    trim = TrimMap()
+    trim.set_biases(BIAS)
+    for index, value in zip(mapping, trim_check):
+        if index != UNMAPPED:
+            trim.trims[index] = value
     return (trim, trim_check)
 
 def write_pattern(file: str, trims: tuple):
@@ -233,35 +150,47 @@ def write_pattern(file: str, trims: tuple):
     Write the pattern to a file
 
     Parameters:
-        pattern (int): Pattern number
-        trim (dict): Dictionary containing the pattern information
-        mapping (dict): Dictionary containing the mapping information
+        file (str): File to write the trims to
+        trims (tuple): Output of make_pattern
     '''
     trim, trim_check = trims
 
+    print(f'Writing pattern {file}')
+    lines = ['side ib channel trim\n']
+    for b, (side, ib) in enumerate(TrimMap.boards()):
+        lines.append(f'BOARD {side} {ib} {BIAS}\n')
+        lines.extend(f'CHANNEL {side} {ib} {channel} {v}\n' for channel, v in enumerate(trim.trims[TrimMap.board_slice(b)]))
     with open(file, 'w') as f:
-        print(f'Writing pattern {file}')
-        f.write(f'side ib channel trim\n')
-        for side in SIDES:
-            for ib in range (IB):
-                f.write(f'BOARD {side} {ib} 55\n')
-                for channel in range(CHANNELS):
-                    f.write(f'CHANNEL {side} {ib} {channel} {trim[side][ib][channel]}\n')
-
-    with open(file.replace('.txt', '_check.txt'), 'w') as f:
-        print(f'Writing pattern {file.replace(".txt", "_check.txt")}')
-        for side in SIDES:
-            for sector in range (SECTORS):
-                for tile in range(TILES):
-                    f.write(f'{side} {sector} {tile} {trim_check[side][sector][tile]}\n')
+        f.write(''.join(lines))
 
-def main():
-    mapping = load_mapping('sEPDMapping.txt')
+    check_file = file.replace('.txt', '_check.txt')
+    print(f'Writing pattern {check_file}')
+    lines = []
+    for side in SIDES:
+        for sector in range (SECTORS):
+            for tile in range(TILES):
+                lines.append(f'{side} {sector} {tile} {trim_check[tile_index(side, sector, tile)]}\n')
+    with open(check_file, 'w') as f:
+        f.write(''.join(lines))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Generate sEPD mapping check patterns')
+    parser.add_argument('--bitplanes', action='store_true', help='Also generate a pattern for every side, sector and tile index bit')
+    parser.add_argument('--random', metavar='n', type=int, default=0, help='Also generate n random patterns')
+    parser.add_argument('--seed', metavar='seed', type=int, help='Seed for the random patterns')
+    args = parser.parse_args(argv[1:])
+
+    mapping = channel_order(MappingIndex.load('sEPDMapping.txt'))
     # make a folder for the patterns
     os.makedirs('patterns', exist_ok=True)
-    for pattern in range(1, 13):
-        trim = make_pattern(pattern, mapping)
-        write_pattern(os.path.join('patterns', f'pattern_{pattern}.txt'), trim)
+    patterns = {f'pattern_{pattern}': mask for pattern, mask in PATTERNS.items()}
+    if args.bitplanes:
+        patterns.update(bit_plane_patterns())
+    if args.random:
+        patterns.update(random_patterns(args.random, args.seed))
+    for name, mask in patterns.items():
+        trim = make_pattern(mask, mapping)
+        write_pattern(os.path.join('patterns', f'{name}.txt'), trim)
 
 if __name__ == '__main__':
-    main()
+    main(sys.argv)
@@ -0,0 +1,184 @@
+#! /usr/bin/python3
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import telnetlib
+import time
+
+import config
+import sEPD_bias_scan
+from bias_controller_simulator import ControllerServer, ControllerState
+
+class RecordingTelnet(telnetlib.Telnet):
+    '''
+    A telnet connection that records the time from writing each command to
+    receiving its prompt.  Commands and prompts are matched in order, as in
+    sEPD_bias_scan.send_commands.
+    '''
+    latencies = []
+
+    def open(self, *args, **kwargs):
+        self.sent = []
+        super().open(*args, **kwargs)
+
+    def write(self, buffer):
+        self.sent.append(time.perf_counter())
+        super().write(buffer)
+
+    def read_until(self, match, timeout=None):
+        response = super().read_until(match, timeout)
+        if response.endswith(match) and self.sent:
+            RecordingTelnet.latencies.append(time.perf_counter() - self.sent.pop(0))
+        return response
+
+class RecordingController(sEPD_bias_scan.BiasController):
+    connection_class = RecordingTelnet
+
+def percentiles(values: list) -> dict:
+    '''
+    Summarize a list of durations in milliseconds.
+
+    Parameters:
+        values: list - The durations in seconds.
+
+    Returns:
+        dict - p50, p95, p99, mean and max in milliseconds.
+    '''
+    if len(values) < 2:
+        values = values * 2 or [0.0, 0.0]
+    quantiles = statistics.quantiles(values, n=100, method='inclusive')
+    return {
+        'p50_ms': quantiles[49] * 1e3,
+        'p95_ms': quantiles[94] * 1e3,
+        'p99_ms': quantiles[98] * 1e3,
+        'mean_ms': statistics.fmean(values) * 1e3,
+        'max_ms': max(values) * 1e3,
+    }
+
+def time_calls(func, repeats: int) -> list:
+    '''
+    Call func repeatedly and return the duration of each call in seconds.
+    '''
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+def start_controllers(latency: float, jitter: float) -> tuple:
+    '''
+    Start a simulated North and South controller on a shared free port.
+
+    Returns:
+        tuple - The servers and the port.
+    '''
+    north = ControllerServer('127.0.0.1', 0, ControllerState(latency=latency, jitter=jitter, seed=1))
+    port = north.server_address[1]
+    south = ControllerServer('127.0.0.2', port, ControllerState(latency=latency, jitter=jitter, seed=2))
+    north.start()
+    south.start()
+    return (north, south), port
+
+def benchmark_controller(latency: float, jitter: float, repeats: int, max_in_flight: int) -> dict:
+    '''
+    Time full trim loads and readbacks against simulated controllers.
+
+    Parameters:
+        latency: float - The simulated reply latency in seconds.
+        jitter: float - The simulated reply jitter in seconds.
+        repeats: int - The number of cycles to time.
+        max_in_flight: int - The pipelining window to use.
+
+    Returns:
+        dict - The timing results.
+    '''
+    servers, port = start_controllers(latency, jitter)
+    config.MAX_IN_FLIGHT = max_in_flight
+    hosts = {'N': '127.0.0.1', 'S': '127.0.0.2'}
+    try:
+        with RecordingController(hosts=hosts, port=port) as controller:
+            trims = controller.get()
+            RecordingTelnet.latencies = []
+            n_before = sum(server.state.commands for server in servers)
+            set_times = time_calls(lambda: controller.set(trims), repeats)
+            get_times = time_calls(controller.get, repeats)
+            n_commands = sum(server.state.commands for server in servers) - n_before
+            command_latencies = RecordingTelnet.latencies
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+    total = sum(set_times) + sum(get_times)
+    return {
+        'latency_ms': latency * 1e3,
+        'jitter_ms': jitter * 1e3,
+        'max_in_flight': max_in_flight,
+        'commands': n_commands,
+        'commands_per_second': n_commands / total if total else 0,
+        'command_latency': percentiles(command_latencies),
+        'set_cycle': percentiles(set_times),
+        'get_cycle': percentiles(get_times),
+    }
+
+def benchmark_files(repeats: int) -> dict:
+    '''
+    Time trim voltage file I/O and bias map generation.
+
+    Parameters:
+        repeats: int - The number of calls to time.
+
+    Returns:
+        dict - The timing results.
+    '''
+    with tempfile.TemporaryDirectory() as folder:
+        config.BIAS_MAPS_FOLDER = folder
+        file_name = os.path.join(folder, 'trim_voltages.txt')
+        sEPD_bias_scan.generate_empty_trim_file(55.0, file_name)
+        trims = sEPD_bias_scan.read_trim_voltage_file(file_name)
+        return {
+            'write_trim_voltage_file': percentiles(time_calls(lambda: sEPD_bias_scan.write_trim_voltage_file(file_name, trims), repeats)),
+            'read_trim_voltage_file': percentiles(time_calls(lambda: sEPD_bias_scan.read_trim_voltage_file(file_name), repeats)),
+            'generate_bias_map': percentiles(time_calls(lambda: sEPD_bias_scan.generate_bias_map(trims.biases), repeats)),
+        }
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the sEPD trim and bias map tools against simulated controllers')
+    parser.add_argument('--latency', metavar='ms', type=float, nargs='*', default=[0, 1, 5, 20], help='Simulated reply latencies to benchmark')
+    parser.add_argument('--jitter', metavar='ms', type=float, default=0, help='Simulated reply jitter')
+    parser.add_argument('--repeats', metavar='n', type=int, default=5, help='Number of cycles per measurement')
+    parser.add_argument('--max_in_flight', metavar='n', type=int, nargs='*', default=[config.MAX_IN_FLIGHT], help='Pipelining windows to benchmark')
+    parser.add_argument('--output', metavar='file_name', type=str, default=os.path.join('run_info', f'benchmark_{config.TIMESTAMP}.json'), help='JSON file for the results')
+    parser.add_argument('--log', metavar='log_level', type=str, default='WARNING', help='Set the logging level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'])
+
+    args = parser.parse_args(argv[1:])
+    logging.basicConfig(level=getattr(logging, args.log))
+    # The bias map template is read relative to the repository
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    config.SIMULATE = False
+
+    results = {'timestamp': config.TIMESTAMP, 'controller': [], 'files': benchmark_files(args.repeats)}
+    for latency in args.latency:
+        for max_in_flight in args.max_in_flight:
+            result = benchmark_controller(latency / 1e3, args.jitter / 1e3, args.repeats, max_in_flight)
+            results['controller'].append(result)
+            print(f'latency {latency:6.1f} ms  window {max_in_flight:3d}  '
+                  f'set p50 {result["set_cycle"]["p50_ms"]:8.1f} ms  get p50 {result["get_cycle"]["p50_ms"]:8.1f} ms  '
+                  f'command p50/p95/p99 {result["command_latency"]["p50_ms"]:.2f}/{result["command_latency"]["p95_ms"]:.2f}/{result["command_latency"]["p99_ms"]:.2f} ms  '
+                  f'{result["commands_per_second"]:8.0f} commands/s')
+    for name, result in results['files'].items():
+        print(f'{name:24s} p50 {result["p50_ms"]:.2f} ms')
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=4)
+    print(f'Results written to {args.output}')
+
+if __name__ == '__main__':
+    main(sys.argv)
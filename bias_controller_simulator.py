@@ -0,0 +1,185 @@
+#! /usr/bin/python3
+
+import argparse
+import logging
+import queue
+import random
+import socketserver
+import sys
+import threading
+import time
+
+import config
+
+class ControllerState:
+    '''
+    The trim voltages held by one simulated bias control system, together
+    with the faults to inject into its replies.
+
+    Parameters:
+        boards: int - The number of interface boards.
+        channels: int - The number of channels per board.
+        latency: float - Seconds between receiving a command and replying.
+        jitter: float - Maximum extra random delay added to each reply.
+        drop: float - Probability that a reply is never sent.
+        mismatch: float - Probability that a $GS stores a wrong value.
+        seed: int - Seed for the random faults.
+    '''
+    def __init__(self, boards: int = 6, channels: int = 64, latency: float = 0.0, jitter: float = 0.0,
+                 drop: float = 0.0, mismatch: float = 0.0, seed: int = None):
+        self.trims = [[0] * channels for _ in range(boards)]
+        self.latency = latency
+        self.jitter = jitter
+        self.drop = drop
+        self.mismatch = mismatch
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.commands = 0
+
+    def handle(self, command: str) -> str:
+        '''
+        Apply one command and return the reply, including the '>' prompt.
+
+        Parameters:
+            command: str - The command, without line endings.
+
+        Returns:
+            str - The reply.
+        '''
+        with self.lock:
+            self.commands += 1
+            try:
+                if command.startswith('$GR'):
+                    ib = int(command[3:4])
+                    return ''.join(f'{v}\n\r' for v in self.trims[ib]) + '>'
+                if command.startswith('$GS'):
+                    ib = int(command[3:4])
+                    channel = int(command[4:6])
+                    value = int(command[6:])
+                    if self.mismatch and self.random.random() < self.mismatch:
+                        value += self.random.choice([-1, 1]) * self.random.randint(1, 10)
+                    self.trims[ib][channel] = value
+                    return '>'
+            except (ValueError, IndexError):
+                pass
+        logging.warning(f'Invalid command: {command}')
+        return 'ERR\n\r>'
+
+    def delay(self) -> float:
+        '''
+        Return the delay before the next reply, or None if it is dropped.
+        '''
+        with self.lock:
+            if self.drop and self.random.random() < self.drop:
+                return None
+            return self.latency + self.random.uniform(0, self.jitter)
+
+class ControllerHandler(socketserver.StreamRequestHandler):
+    '''
+    Serve one client connection.  Replies are sent from a separate thread at
+    the time they are due, so commands written back to back see the latency
+    once rather than once per command.
+    '''
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        state = self.server.state
+        replies = queue.Queue()
+        sender = threading.Thread(target=self.send_replies, args=(replies,), daemon=True)
+        sender.start()
+        last_due = 0
+        try:
+            for line in self.rfile:
+                command = line.decode('ascii', errors='replace').strip()
+                if not command:
+                    continue
+                reply = state.handle(command)
+                delay = state.delay()
+                if delay is None:
+                    logging.debug(f'Dropping reply to {command}')
+                    continue
+                # Replies leave in the order the commands arrived
+                last_due = max(last_due, time.monotonic() + delay)
+                replies.put((last_due, reply.encode('ascii')))
+        except ConnectionError:
+            pass
+        finally:
+            replies.put(None)
+            sender.join()
+
+    def send_replies(self, replies: queue.Queue) -> None:
+        while True:
+            item = replies.get()
+            if item is None:
+                return
+            due, reply = item
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                self.wfile.write(reply)
+                self.wfile.flush()
+            except (ConnectionError, ValueError):
+                return
+
+class ControllerServer(socketserver.ThreadingTCPServer):
+    '''
+    A TCP server emulating the $GR/$GS protocol of one bias control system.
+
+    Parameters:
+        host: str - The address to listen on.
+        port: int - The port to listen on.  0 picks a free port.
+        state: ControllerState - The simulated controller.
+    '''
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host: str, port: int, state: ControllerState):
+        self.state = state
+        super().__init__((host, port), ControllerHandler)
+
+    def start(self) -> threading.Thread:
+        '''
+        Serve in a background thread.
+
+        Returns:
+            threading.Thread - The thread serving requests.
+        '''
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Simulated sEPD bias control system')
+    parser.add_argument('--host', metavar='address', type=str, action='append', help='Address to listen on, one simulated controller per address (default 127.0.0.1 and 127.0.0.2)')
+    parser.add_argument('--port', metavar='port', type=int, default=config.PORT, help='Port to listen on')
+    parser.add_argument('--latency', metavar='seconds', type=float, default=0.0, help='Delay before each reply')
+    parser.add_argument('--jitter', metavar='seconds', type=float, default=0.0, help='Maximum random extra delay before each reply')
+    parser.add_argument('--drop', metavar='probability', type=float, default=0.0, help='Probability of not replying to a command')
+    parser.add_argument('--mismatch', metavar='probability', type=float, default=0.0, help='Probability of storing a wrong trim voltage')
+    parser.add_argument('--seed', metavar='seed', type=int, help='Seed for the injected faults')
+    parser.add_argument('--log', metavar='log_level', type=str, default='INFO', help='Set the logging level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'])
+
+    args = parser.parse_args(argv[1:])
+    logging.basicConfig(level=getattr(logging, args.log))
+
+    servers = []
+    for host in args.host or ['127.0.0.1', '127.0.0.2']:
+        state = ControllerState(latency=args.latency, jitter=args.jitter, drop=args.drop, mismatch=args.mismatch, seed=args.seed)
+        server = ControllerServer(host, args.port, state)
+        server.start()
+        servers.append(server)
+        logging.info(f'Simulated controller listening on {host}:{args.port}')
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,154 @@
+#! /usr/bin/python3
+
+import argparse
+import concurrent.futures
+import datetime
+import json
+import logging
+import os
+import queue
+import socketserver
+import sys
+import threading
+
+import config
+from daemon_client import DaemonClient
+from sEPD_bias_scan import BiasController, apply_trim_voltages, backup, get_loaded_voltages, read_loaded_biases
+from trim_map import TrimMap, N_BOARDS
+
+class BiasDaemon:
+    '''
+    Serves get/set/diff/backup requests from local clients over one
+    long-lived BiasController session.
+
+    Requests are queued and applied by a single worker thread in the order
+    they arrive, whichever client sent them.  The trim and board voltages
+    are cached after the first readback and kept up to date by every set,
+    so get is answered without talking to the controllers.  The board
+    voltages are read from the installed bias map on every request, since
+    scans install bias maps without going through the daemon.
+
+    Parameters:
+        controller: BiasController - The session to use.
+    '''
+    def __init__(self, controller: BiasController):
+        self.controller = controller
+        self.state = None
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self.work, daemon=True)
+        self.worker.start()
+
+    def submit(self, request: dict) -> dict:
+        '''
+        Queue a request and wait for its response.
+        '''
+        future = concurrent.futures.Future()
+        self.requests.put((request, future))
+        return future.result()
+
+    def work(self) -> None:
+        while True:
+            request, future = self.requests.get()
+            try:
+                handler = getattr(self, f'op_{request.get("op")}', None)
+                if handler is None:
+                    raise ValueError(f'Unknown request {request.get("op")!r}')
+                response = handler(request)
+                response['ok'] = True
+            except (Exception, SystemExit) as e:
+                logging.error(f'{request.get("op")} failed: {e!r}')
+                response = {'ok': False, 'error': str(e) or repr(e)}
+            future.set_result(response)
+
+    def current(self, refresh: bool = False) -> TrimMap:
+        if refresh or self.state is None:
+            self.state = get_loaded_voltages(self.controller)
+        else:
+            biases = read_loaded_biases()
+            if biases is not None:
+                self.state.biases = biases
+        return self.state
+
+    def op_ping(self, request: dict) -> dict:
+        return {}
+
+    def op_get(self, request: dict) -> dict:
+        state = self.current(request.get('refresh', False))
+        return {'trims': list(state.trims), 'biases': list(state.biases)}
+
+    def op_set(self, request: dict) -> dict:
+        trim_map = TrimMap(request['trims'], request['biases'])
+        differential = request.get('differential', False)
+        # Something else may have written to the controllers since the last
+        # request, so the differences are taken from a fresh readback
+        current = self.current(refresh=True) if differential else None
+        verified = apply_trim_voltages(trim_map, differential, self.controller, request.get('ramp', False), current)
+        # a failed set leaves the controllers in an unknown state
+        self.state = trim_map.clipped() if verified else None
+        logging.info(f'Set trim voltages, differential={differential}, ramp={request.get("ramp", False)}, verified={verified}')
+        return {'verified': verified}
+
+    def op_diff(self, request: dict) -> dict:
+        trim_map = TrimMap(request['trims'], request['biases'])
+        state = self.current()
+        return {
+            'channels': trim_map.diff(state),
+            'boards': [b for b in range(N_BOARDS) if trim_map.biases[b] != state.biases[b]],
+        }
+
+    def op_backup(self, request: dict) -> dict:
+        timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+        self.state = backup(self.controller, timestamp)
+        return {'timestamp': timestamp}
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    '''
+    Reads requests from one client, one JSON line each, and writes the
+    responses back in order.
+    '''
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except json.JSONDecodeError as e:
+                response = {'ok': False, 'error': f'Malformed request: {e}'}
+            else:
+                response = self.server.bias_daemon.submit(request)
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+            self.wfile.flush()
+
+class DaemonServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, daemon: BiasDaemon):
+        if os.path.exists(path):
+            client = DaemonClient.connect(path)
+            if client is not None:
+                client.close()
+                raise RuntimeError(f'A daemon is already listening on {path}')
+            # left behind by a daemon that did not shut down cleanly
+            os.remove(path)
+        super().__init__(path, RequestHandler)
+        self.bias_daemon = daemon
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Keep the sEPD bias control connections open and serve requests over a Unix socket')
+    parser.add_argument('--socket', metavar='path', type=str, default=config.DAEMON_SOCKET, help='Socket to listen on')
+    parser.add_argument('--log', metavar='log_level', type=str, default='INFO', help='Set the logging level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'])
+    args = parser.parse_args(argv[1:])
+    logging.basicConfig(level=getattr(logging, args.log))
+
+    os.makedirs(config.BIAS_MAPS_FOLDER, exist_ok=True)
+    with BiasController() as controller:
+        server = DaemonServer(args.socket, BiasDaemon(controller))
+        logging.info(f'Listening on {args.socket}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.remove(args.socket)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+import string
+import time
+
+import config
+
+TEMPLATE_FILE = 'sEPD_HVSet_template.txt'
+# Name of a bias map once installed in the bias control folder
+INSTALLED_NAME = 'sEPD_HVSet.txt'
+MANIFEST_NAME = 'bias_map_manifest.jsonl'
+# Decimals of the board voltages in the template ({:.1f}).  Voltages are
+# loaded rounded to this.
+BIAS_DECIMALS = 1
+
+class BiasMapTemplate:
+    '''
+    A parsed bias map template.
+
+    Lines with a format field take one board voltage each, in order; the
+    other lines (spare channels) are copied as they are.  The whole template
+    is compiled into one format string, so rendering a map is one call.
+
+    Parameters:
+        text: str - The template.
+    '''
+    def __init__(self, text: str):
+        self.lines = text.splitlines(keepends=True)
+        # line number of every placeholder, in voltage order
+        self.slots = []
+        pieces = []
+        for n, line in enumerate(self.lines):
+            if '{' not in line:
+                pieces.append(line)
+                continue
+            for literal, field, spec, conversion in string.Formatter().parse(line):
+                pieces.append(literal.replace('{', '{{').replace('}', '}}'))
+                if field is not None:
+                    pieces.append('{%d%s%s}' % (len(self.slots), f'!{conversion}' if conversion else '', f':{spec}' if spec else ''))
+            self.slots.append(n)
+        self.format_string = ''.join(pieces)
+
+    def render(self, voltages: list) -> str:
+        '''
+        Return the bias map for a list of board voltages.
+        '''
+        if len(voltages) < len(self.slots):
+            raise ValueError(f'The bias map template needs {len(self.slots)} voltages, got {len(voltages)}')
+        return self.format_string.format(*voltages)
+
+    def parse(self, text: str) -> list:
+        '''
+        Return the board voltages of a bias map rendered from the template.
+        '''
+        lines = text.splitlines()
+        return [float(lines[n].split()[1]) for n in self.slots]
+
+templates = {}
+
+def load_template(file_name: str = TEMPLATE_FILE) -> BiasMapTemplate:
+    '''
+    Return the parsed template, reading the file again only if it changed.
+    '''
+    mtime = os.stat(file_name).st_mtime_ns
+    cached = templates.get(file_name)
+    if cached is None or cached[0] != mtime:
+        with open(file_name, 'r') as f:
+            cached = templates[file_name] = (mtime, BiasMapTemplate(f.read()))
+    return cached[1]
+
+def write_atomic(file_name: str, data) -> None:
+    '''
+    Write a file so that readers only ever see the old or the new contents.
+    The file is written in binary mode if data is bytes.
+    '''
+    tmp_file = f'{file_name}.{os.getpid()}.tmp'
+    with open(tmp_file, 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+    os.replace(tmp_file, file_name)
+
+def append_manifest(record: dict, folder: str = None) -> None:
+    '''
+    Add a record to the manifest of bias maps in the bias maps folder.
+    '''
+    if folder is None:
+        folder = config.BIAS_MAPS_FOLDER
+    with open(os.path.join(folder, MANIFEST_NAME), 'a') as f:
+        f.write(json.dumps(dict(record, time=time.time())) + '\n')
+
+def render_bias_maps(voltage_sets: list, folder: str = None, template: BiasMapTemplate = None) -> list:
+    '''
+    Render a bias map for every set of board voltages.
+
+    Each map is named after the hash of its contents, so identical maps
+    share one file and a map is never overwritten by a different one.  Every
+    map is recorded in the manifest with its voltages.
+
+    Parameters:
+        voltage_sets: list - The board voltages of every map.
+        folder: str - Where to write the maps.  Defaults to
+                      config.BIAS_MAPS_FOLDER.
+        template: BiasMapTemplate - Defaults to the template file.
+
+    Returns:
+        list - The file names of the maps, in order.
+    '''
+    if folder is None:
+        folder = config.BIAS_MAPS_FOLDER
+    if template is None:
+        template = load_template()
+    file_names = []
+    for voltages in voltage_sets:
+        text = template.render(voltages)
+        digest = hashlib.sha256(text.encode()).hexdigest()
+        file_name = os.path.join(folder, f'sEPD_HVSet_{digest[:16]}.txt')
+        if not os.path.exists(file_name):
+            write_atomic(file_name, text)
+            append_manifest({'type': 'render', 'file': file_name, 'sha256': digest, 'voltages': list(voltages)}, folder)
+        file_names.append(file_name)
+    return file_names
+
+def install_bias_map(file_name: str, folder: str = None) -> str:
+    '''
+    Install a bias map in the bias control folder.  The installed map is
+    replaced atomically and the source file is kept.
+
+    Parameters:
+        file_name: str - The bias map.
+        folder: str - Defaults to config.BIAS_CONTROL_FOLDER.
+
+    Returns:
+        str - The file name of the installed map.
+    '''
+    if folder is None:
+        folder = config.BIAS_CONTROL_FOLDER
+    with open(file_name, 'r') as f:
+        text = f.read()
+    target = os.path.join(folder, INSTALLED_NAME)
+    write_atomic(target, text)
+    append_manifest({'type': 'install', 'file': file_name, 'sha256': hashlib.sha256(text.encode()).hexdigest(), 'target': target})
+    return target
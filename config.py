@@ -4,10 +4,80 @@ BIAS_CONTROL_FOLDER = '/Users/tristan/sphenix/sEPD/bias_scan/BiasControl'
 BIAS_MAPS_FOLDER = '/Users/tristan/sphenix/sEPD/bias_scan/bias_maps'
 SEB = 'seb20'
 VGTM = '8'
+# Shortest and longest time between DAQ event count checks, in seconds
+DAQ_POLL_MIN_INTERVAL = 0.2
+DAQ_POLL_MAX_INTERVAL = 5.0
+# Take runs with the DAQ clients (see daq_control.py).  Off, runs are left to
+# the shift crew and record_events only waits for the bias supplies.
+DAQ_ENABLED = False
+# Seconds to wait for a DAQ client before giving up
+DAQ_TIMEOUT = 30.0
+# Folder holding jseb2client, rcdaq_client and gl1_gtm_client.  None uses the PATH.
+DAQ_BIN_DIR = None
+# Seconds to wait for the bias supplies after loading a bias map
+BIAS_SETTLE_TIME = 1.0
+MAPPING_FILE = 'sEPDMapping.txt'
+# Waveform tree written by WD409 and the branch holding one amplitude per
+# channel, in TrimMap order
+WAVEFORM_TREE = 'W'
+AMPLITUDE_BRANCH = 'amplitude'
+# Binning of the per-channel amplitude spectra
+AMPLITUDE_BINS = 500
+AMPLITUDE_RANGE = (0.0, 5000.0)
+# Amplitudes below this are pedestal when looking for the MIP peak
+MIP_THRESHOLD = 200.0
+# Threads used to reduce scan data.  0 uses every core.
+REDUCTION_THREADS = 0
+# Fewest counts above MIP_THRESHOLD for a channel to count as on in a
+# mapping check pattern
+PATTERN_ON_THRESHOLD = 100
+# Volts per trim voltage count
+TRIM_VOLTS_PER_COUNT = 0.001
+# Fewest MIP peak counts for a scan point to be used in a gain fit
+GAIN_MIN_COUNTS = 50
+# Cache of reduced per-run summaries and its size limit in bytes
+CACHE_FOLDER = 'run_info/cache'
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+# History of every trim and bias snapshot (see trim_history.py).  None
+# disables it.
+HISTORY_DB = f'{BIAS_MAPS_FOLDER}/trim_history.sqlite'
 TIMESTAMP = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
 
 NORTH_IP = '10.20.34.98'
 SOUTH_IP = '10.20.34.99'
 PORT = 9760
 
+# The bias control systems.  The name is the side label used in commands
+# and files; every controller has its own number of boards and channels
+# per board.  Test stands and larger systems only need a different list.
+CONTROLLERS = [
+    {'name': 'N', 'host': NORTH_IP, 'port': PORT, 'boards': 6, 'channels': 64},
+    {'name': 'S', 'host': SOUTH_IP, 'port': PORT, 'boards': 6, 'channels': 64},
+]
+# Most controllers talked to at the same time
+MAX_PARALLEL_CONTROLLERS = 8
+
+# Socket of bias_daemon.py, and seconds a client waits for it to answer
+DAEMON_SOCKET = '/tmp/sepd_bias_daemon.sock'
+DAEMON_TIMEOUT = 60.0
+
+# Maximum number of commands written to a controller before waiting for its prompt.
+# 1 sends one command per round trip.
+MAX_IN_FLIGHT = 32
+# Seconds to wait for a controller prompt before giving up
+COMMAND_TIMEOUT = 5.0
+
+# Ramps of the trim voltages (see trim_ramp.py): the largest change of a
+# channel in one step, in counts, and the fastest a board is ramped, in
+# counts per second.  A CONTROLLERS entry can set its own 'ramp_rate'.
+RAMP_STEP = 500
+RAMP_RATE = 1000.0
+
+# Record the time taken by controller, file and DAQ operations (see timing.py)
+TIMING = False
+
+# Skip the network and fake the bias control systems.  To exercise the real
+# I/O path without hardware, set SIMULATE = False, run
+# bias_controller_simulator.py and point the CONTROLLERS hosts at 127.0.0.1
+# and 127.0.0.2.
 SIMULATE = True
\ No newline at end of file
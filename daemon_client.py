@@ -0,0 +1,115 @@
+import json
+import logging
+import socket
+
+import config
+from trim_map import TrimMap
+
+class DaemonError(Exception):
+    '''
+    Raised when the bias control daemon rejects or fails a request.
+    '''
+    pass
+
+class DaemonClient:
+    '''
+    A connection to bias_daemon.py.
+
+    Requests and responses are single lines of JSON.  The daemon applies
+    requests from all clients one at a time, in the order they arrive.
+
+    Parameters:
+        sock: socket.socket - The connected socket.
+    '''
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.file = sock.makefile('rwb')
+
+    @classmethod
+    def connect(cls, path: str = None, timeout: float = None) -> 'DaemonClient':
+        '''
+        Connect to the daemon.
+
+        Parameters:
+            path: str - The daemon socket.  Defaults to config.DAEMON_SOCKET.
+            timeout: float - Seconds to wait for a response.  Defaults to
+                             config.DAEMON_TIMEOUT.
+
+        Returns:
+            DaemonClient - The connection, or None if no daemon is running.
+        '''
+        if path is None:
+            path = config.DAEMON_SOCKET
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(config.DAEMON_TIMEOUT if timeout is None else timeout)
+        try:
+            sock.connect(path)
+        except OSError:
+            sock.close()
+            return None
+        logging.debug(f'Connected to the bias control daemon at {path}')
+        return cls(sock)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        self.file.close()
+        self.sock.close()
+
+    def request(self, op: str, **fields) -> dict:
+        '''
+        Send a request and return the response.
+
+        Raises:
+            DaemonError - If the daemon reports an error or hangs up.
+        '''
+        self.file.write(json.dumps(dict(fields, op=op)).encode() + b'\n')
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise DaemonError(f'The daemon closed the connection during {op}')
+        response = json.loads(line)
+        if not response.get('ok'):
+            raise DaemonError(f'{op} failed: {response.get("error")}')
+        return response
+
+    def get(self, refresh: bool = False) -> TrimMap:
+        '''
+        Return the trim and board voltages.  The daemon answers from its
+        cached state unless refresh is True or it has none.
+        '''
+        response = self.request('get', refresh=refresh)
+        return TrimMap(response['trims'], response['biases'])
+
+    def set(self, trim_map: TrimMap, differential: bool = False, ramp: bool = False) -> bool:
+        '''
+        Set the trim voltages and load a bias map with the board voltages.
+        With ramp, the trims are ramped in bounded steps.
+
+        Returns:
+            bool - True if the readback matches the requested trim voltages.
+        '''
+        return self.request('set', trims=list(trim_map.trims), biases=list(trim_map.biases), differential=differential, ramp=ramp)['verified']
+
+    def diff(self, trim_map: TrimMap) -> dict:
+        '''
+        Compare trim and board voltages to the daemon's current state.
+
+        Returns:
+            dict - The flat indices of the differing 'channels' and 'boards'.
+        '''
+        response = self.request('diff', trims=list(trim_map.trims), biases=list(trim_map.biases))
+        return {'channels': response['channels'], 'boards': response['boards']}
+
+    def backup(self) -> str:
+        '''
+        Back up the bias map and the trim voltages.
+
+        Returns:
+            str - The timestamp of the backup files.
+        '''
+        return self.request('backup')['timestamp']
@@ -0,0 +1,240 @@
+import asyncio
+import logging
+import os
+import re
+import time
+
+import config
+import timing
+
+class DAQError(Exception):
+    '''
+    Raised when a DAQ client fails, times out, or gives unexpected output.
+    '''
+    pass
+
+class PollSchedule:
+    '''
+    Decides when to next check the event count of a run.
+
+    The event rate is estimated from successive counts and the next check
+    is scheduled for shortly before the target is expected, so the run is
+    not left going for a whole polling period after it is done.
+
+    Parameters:
+        n_events: int - The number of events to wait for.
+        min_interval: float - Shortest time between checks.  Defaults to
+                              config.DAQ_POLL_MIN_INTERVAL.
+        max_interval: float - Longest time between checks.  Defaults to
+                              config.DAQ_POLL_MAX_INTERVAL.
+    '''
+    def __init__(self, n_events: int, min_interval: float = None, max_interval: float = None):
+        self.n_events = n_events
+        self.min_interval = config.DAQ_POLL_MIN_INTERVAL if min_interval is None else min_interval
+        self.max_interval = config.DAQ_POLL_MAX_INTERVAL if max_interval is None else max_interval
+        self.start = time.monotonic()
+        self.polls = 0
+        self.poll_time = 0.0
+        self.rate = None
+        self.count = None
+        self.last_time = None
+
+    def record(self, count: int, poll_start: float, poll_end: float) -> float:
+        '''
+        Record the result of a check.
+
+        Parameters:
+            count: int - The event count.
+            poll_start: float - time.monotonic() before the check.
+            poll_end: float - time.monotonic() after the check.
+
+        Returns:
+            float - Seconds to wait before the next check, or None once the
+                    target is reached.
+        '''
+        self.polls += 1
+        self.poll_time += poll_end - poll_start
+        if count >= self.n_events:
+            self.count = count
+            return None
+
+        if self.count is not None and count > self.count:
+            measured = (count - self.count) / (poll_end - self.last_time)
+            # smooth the estimate over successive polls
+            self.rate = measured if self.rate is None else 0.5 * (self.rate + measured)
+        self.count = count
+        self.last_time = poll_end
+
+        if self.rate:
+            # aim to check just before the target should be reached
+            expected = (self.n_events - count) / self.rate - self.poll_time / self.polls
+            interval = 0.9 * expected
+        else:
+            interval = self.min_interval
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def summary(self) -> dict:
+        '''
+        Return the number of polls, the time spent polling, the total wait,
+        the last event rate estimate and the last count.
+        '''
+        return {
+            'polls': self.polls,
+            'poll_time': self.poll_time,
+            'wait_time': time.monotonic() - self.start,
+            'rate': self.rate,
+            'last_count': self.count,
+        }
+
+def parse_int(output: str, pattern: str = None) -> int:
+    '''
+    Find an integer in the output of a DAQ client.
+
+    Parameters:
+        output: str - The output.
+        pattern: str - Optional regular expression with one group around
+                       the integer.  The last integer in the output is
+                       used if it does not match.
+
+    Returns:
+        int - The integer.
+    '''
+    if pattern is not None:
+        match = re.search(pattern, output, re.IGNORECASE)
+        if match:
+            return int(match.group(1))
+    numbers = re.findall(r'-?\d+', output)
+    if not numbers:
+        raise DAQError(f'No number in DAQ client output: {output.strip()!r}')
+    return int(numbers[-1])
+
+class DAQControl:
+    '''
+    Runs the jseb2client, rcdaq_client and gl1_gtm_client programs as
+    asynchronous subprocesses with timeouts.
+
+    Parameters:
+        seb: str - The SEB to initialize.  Defaults to config.SEB.
+        vgtm: str - The vGTM to start and stop.  Defaults to config.VGTM.
+        timeout: float - Seconds to wait for each client.  Defaults to
+                         config.DAQ_TIMEOUT.
+        bin_dir: str - Folder holding the clients.  Defaults to
+                       config.DAQ_BIN_DIR, and to the PATH if that is None.
+                       Point it at fake clients to test without a DAQ.
+    '''
+    def __init__(self, seb: str = None, vgtm: str = None, timeout: float = None, bin_dir: str = None):
+        self.seb = config.SEB if seb is None else seb
+        self.vgtm = config.VGTM if vgtm is None else vgtm
+        self.timeout = config.DAQ_TIMEOUT if timeout is None else timeout
+        self.bin_dir = config.DAQ_BIN_DIR if bin_dir is None else bin_dir
+
+    async def run(self, client: str, *args: str, timeout: float = None) -> str:
+        '''
+        Run a DAQ client and return its output.
+
+        Parameters:
+            client: str - The client program.
+            args: str - Its arguments.
+            timeout: float - Seconds to wait.  Defaults to self.timeout.
+
+        Returns:
+            str - The standard output of the client.
+
+        Raises:
+            DAQError - If the client cannot be started, times out, or exits
+                       with an error.
+        '''
+        if timeout is None:
+            timeout = self.timeout
+        program = os.path.join(self.bin_dir, client) if self.bin_dir else client
+        command = ' '.join((client,) + args)
+        logging.debug(f'Running {command}')
+        with timing.timer(f'daq.{client}.{args[0]}' if args else f'daq.{client}'):
+            try:
+                process = await asyncio.create_subprocess_exec(program, *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            except OSError as e:
+                raise DAQError(f'Cannot run {client}: {e}') from e
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                raise DAQError(f'{command} timed out after {timeout} s')
+        if process.returncode != 0:
+            raise DAQError(f'{command} exited with {process.returncode}: {stderr.decode(errors="replace").strip()}')
+        return stdout.decode(errors='replace')
+
+    async def init(self) -> None:
+        await self.run('jseb2client', 'init', self.seb)
+
+    async def start(self) -> int:
+        '''
+        Begin a run and start the triggers.
+
+        Returns:
+            int - The run number.
+        '''
+        output = await self.run('rcdaq_client', 'daq_begin')
+        run_number = parse_int(output, r'run\D*(\d+)')
+        await self.run('gl1_gtm_client', 'gtm_startrun', self.vgtm)
+        return run_number
+
+    async def event_count(self) -> int:
+        return parse_int(await self.run('rcdaq_client', 'daq_get_numberevents'))
+
+    async def wait_for_events(self, n_events: int) -> dict:
+        '''
+        Wait until the run has n_events.  See PollSchedule.
+
+        Returns:
+            dict - The polling summary.
+        '''
+        schedule = PollSchedule(n_events)
+        while True:
+            poll_start = time.monotonic()
+            count = await self.event_count()
+            interval = schedule.record(count, poll_start, time.monotonic())
+            if interval is None:
+                return schedule.summary()
+            await asyncio.sleep(interval)
+
+    async def stop(self) -> None:
+        '''
+        Stop the triggers, then end the run.
+        '''
+        await self.run('gl1_gtm_client', 'gtm_stop', self.vgtm)
+        await self.run('rcdaq_client', 'daq_end')
+
+    async def last_file(self) -> str:
+        return (await self.run('rcdaq_client', 'daq_get_lastfilename')).strip()
+
+    async def last_event_number(self) -> int:
+        return parse_int(await self.run('rcdaq_client', 'daq_get_last_event_number'))
+
+    async def record(self, n_events: int, settle: float = 0.0) -> dict:
+        '''
+        Take a run with n_events.
+
+        The SEB is initialized while the bias supplies settle, and the
+        output file and event count are queried together after the run.
+
+        Parameters:
+            n_events: int - The number of events to record.
+            settle: float - Seconds to wait for the bias supplies.
+
+        Returns:
+            dict - Information about the run.
+        '''
+        run_info = {}
+        await asyncio.gather(self.init(), asyncio.sleep(settle))
+
+        logging.info('Starting run')
+        run_info['run_number'] = await self.start()
+        try:
+            run_info['polling'] = await self.wait_for_events(n_events)
+        finally:
+            logging.info('Stopping run')
+            await self.stop()
+        await asyncio.sleep(0.5)
+        run_info['file_path'], run_info['num_events'] = await asyncio.gather(self.last_file(), self.last_event_number())
+        return run_info
@@ -0,0 +1,173 @@
+#! /usr/bin/python3
+
+import argparse
+import array
+import json
+import logging
+import math
+import statistics
+import sys
+
+import config
+from bias_map import BIAS_DECIMALS
+from sEPD_bias_scan import channel_label, read_trim_voltage_file, write_trim_voltage_file
+from trim_map import TrimMap, N_BOARDS, N_CHANNELS, TRIM_LIMIT
+
+def load_reduced(file_name: str) -> dict:
+    '''
+    Read the reduced scan written by sEPD_gain_matching.
+
+    Parameters:
+        file_name: str - The reduced scan JSON file.
+
+    Returns:
+        dict - The summary of every point, by voltage.
+    '''
+    with open(file_name, 'r') as f:
+        return {float(voltage): summary for voltage, summary in json.load(f).items()}
+
+def fit_gains(reduced: dict, trims: TrimMap = None, min_counts: float = None) -> dict:
+    '''
+    Fit the MIP peak of every channel as a straight line in its bias.
+
+    Each channel's bias is the scan voltage plus its trim.  The sums of the
+    least squares normal equations are accumulated for all channels one scan
+    point at a time and solved in closed form, weighting each point by its
+    counts above the MIP threshold.  Points with fewer than min_counts of
+    them are left out.
+
+    Parameters:
+        reduced: dict - The summary of every point, by voltage, with
+                        per-channel 'peak' and 'mip_counts'.
+        trims: TrimMap - The trims loaded during the scan.  Defaults to 0.
+        min_counts: float - Fewest MIP counts for a point to be used.  Defaults
+                            to config.GAIN_MIN_COUNTS.
+
+    Returns:
+        dict - The per-channel 'slope' (peak per volt), 'intercept',
+               'residual' (rms, in peak units) and number of 'points', and
+               the scan 'voltages'.
+               Channels with fewer than two usable points, or a slope that
+               is not positive, have a nan slope.
+    '''
+    if trims is None:
+        trims = TrimMap()
+    if min_counts is None:
+        min_counts = config.GAIN_MIN_COUNTS
+    offsets = [trim * config.TRIM_VOLTS_PER_COUNT for trim in trims.trims]
+
+    n = array.array('i', [0] * N_CHANNELS)
+    sw = array.array('d', [0.0] * N_CHANNELS)
+    sx = array.array('d', [0.0] * N_CHANNELS)
+    sy = array.array('d', [0.0] * N_CHANNELS)
+    sxx = array.array('d', [0.0] * N_CHANNELS)
+    sxy = array.array('d', [0.0] * N_CHANNELS)
+    syy = array.array('d', [0.0] * N_CHANNELS)
+    for voltage, summary in reduced.items():
+        for k, (w, y) in enumerate(zip(summary['mip_counts'], summary['peak'])):
+            if w < min_counts:
+                continue
+            x = voltage + offsets[k]
+            n[k] += 1
+            sw[k] += w
+            sx[k] += w * x
+            sy[k] += w * y
+            sxx[k] += w * x * x
+            sxy[k] += w * x * y
+            syy[k] += w * y * y
+
+    fit = {
+        'slope': array.array('d', [math.nan] * N_CHANNELS),
+        'intercept': array.array('d', [math.nan] * N_CHANNELS),
+        'residual': array.array('d', [math.nan] * N_CHANNELS),
+        'points': n,
+        'voltages': sorted(reduced),
+    }
+    for k in range(N_CHANNELS):
+        determinant = sw[k] * sxx[k] - sx[k] * sx[k]
+        if n[k] < 2 or determinant <= 0:
+            continue
+        slope = (sw[k] * sxy[k] - sx[k] * sy[k]) / determinant
+        if slope <= 0:
+            continue
+        intercept = (sy[k] - slope * sx[k]) / sw[k]
+        # weighted sum of squared residuals from the same sums
+        chi2 = syy[k] - 2 * slope * sxy[k] - 2 * intercept * sy[k] + slope * slope * sxx[k] + 2 * slope * intercept * sx[k] + intercept * intercept * sw[k]
+        fit['slope'][k] = slope
+        fit['intercept'][k] = intercept
+        fit['residual'][k] = math.sqrt(max(chi2, 0.0) / sw[k])
+    return fit
+
+def solve_trims(fit: dict, target: float = None, biases: list = None) -> TrimMap:
+    '''
+    Find the trims that bring every channel's MIP peak to the target.
+
+    Unless biases are given, each board is set to the median bias its
+    channels need, so the trims use as little of their range as possible.
+    Board biases are rounded as the bias map will load them before the
+    trims are worked out from them.  Trims beyond TRIM_LIMIT are clipped to it, and
+    channels without a fit are left at 0.
+
+    Parameters:
+        fit: dict - The result of fit_gains.
+        target: float - The MIP peak to aim for.  Defaults to the median
+                        fitted peak at the median scan voltage.
+        biases: list - Optional bias voltage of every board.
+
+    Returns:
+        TrimMap - The trims and board biases.
+    '''
+    fitted = [k for k in range(N_CHANNELS) if not math.isnan(fit['slope'][k])]
+    if not fitted:
+        raise ValueError('No channel has a usable gain fit')
+    if target is None:
+        voltage = statistics.median(fit['voltages'])
+        target = statistics.median(fit['intercept'][k] + fit['slope'][k] * voltage for k in fitted)
+        logging.info(f'Target MIP peak {target:.1f}')
+    required = array.array('d', [math.nan] * N_CHANNELS)
+    for k in fitted:
+        required[k] = (target - fit['intercept'][k]) / fit['slope'][k]
+
+    trim_map = TrimMap()
+    for b in range(N_BOARDS):
+        board = [v for v in required[TrimMap.board_slice(b)] if not math.isnan(v)]
+        if biases is not None:
+            trim_map.biases[b] = round(biases[b], BIAS_DECIMALS)
+        elif board:
+            trim_map.biases[b] = round(statistics.median(board), BIAS_DECIMALS)
+        else:
+            logging.warning(f'No fitted channel on board {TrimMap.boards()[b]}, its bias is left at 0')
+
+    for k in range(N_CHANNELS):
+        if math.isnan(required[k]):
+            logging.warning(f'No gain fit: {channel_label(k)}.  Its trim is left at 0.')
+            continue
+        trim = round((required[k] - trim_map.biases[TrimMap.board_of(k)]) / config.TRIM_VOLTS_PER_COUNT)
+        if abs(trim) > TRIM_LIMIT:
+            logging.warning(f'Trim out of range: {channel_label(k)}, Trim={trim}.  {math.copysign(TRIM_LIMIT, trim):.0f} will be used instead.')
+            trim = int(math.copysign(TRIM_LIMIT, trim))
+        trim_map.trims[k] = trim
+    return trim_map
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Solve for the sEPD trim voltages that match the channel gains')
+    parser.add_argument('reduced', metavar='reduced', type=str, help='Reduced scan JSON file written by sEPD_gain_matching')
+    parser.add_argument('output', metavar='output_file_name', type=str, help='Trim voltage file to write (binary snapshot if it ends in .snap)')
+    parser.add_argument('--trims', metavar='file_name', type=str, help='Trim voltage file loaded during the scan (default: all 0)')
+    parser.add_argument('--target', metavar='peak', type=float, help='MIP peak to aim for (default: the median channel at the median voltage)')
+    parser.add_argument('--bias', metavar='voltage', type=float, help='Set every board to this bias instead of choosing one per board')
+    parser.add_argument('--log', metavar='log_level', type=str, default='INFO', help='Set the logging level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'])
+    args = parser.parse_args(argv[1:])
+    logging.basicConfig(level=getattr(logging, args.log))
+
+    reduced = load_reduced(args.reduced)
+    trims = read_trim_voltage_file(args.trims) if args.trims else None
+    fit = fit_gains(reduced, trims)
+    fitted = sum(1 for slope in fit['slope'] if not math.isnan(slope))
+    logging.info(f'Fitted {fitted} of {N_CHANNELS} channels over {len(reduced)} scan points')
+    trim_map = solve_trims(fit, args.target, None if args.bias is None else [args.bias] * N_BOARDS)
+    write_trim_voltage_file(args.output, trim_map)
+    logging.info(f'Wrote {args.output}')
+
+if __name__ == '__main__':
+    main(sys.argv)
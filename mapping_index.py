@@ -0,0 +1,189 @@
+import array
+import hashlib
+import logging
+import os
+import struct
+import sys
+
+from bias_map import write_atomic
+from trim_map import TrimMap, SIDES, N_CHANNELS
+
+SECTORS = 12
+TILES = 32
+N_TILES = len(SIDES) * SECTORS * TILES
+
+# Marks a tile without a channel, or a channel without a tile
+UNMAPPED = -1
+
+# Cache layout: magic, byte order, sha256 of the source file, then the
+# forward and inverse arrays as native 16 bit integers
+CACHE_MAGIC = b'SEPDMAP1'
+CACHE_HEADER = struct.Struct('8s1s32s')
+
+def tile_index(side: str, sector: int, tile: int) -> int:
+    '''
+    Return the flat index of a tile, ordered by side, sector and tile.
+    '''
+    return (SIDES.index(side) * SECTORS + sector) * TILES + tile
+
+def tile_location(index: int) -> tuple:
+    '''
+    Return the (side, sector, tile) of a flat tile index.
+    '''
+    side_sector, tile = divmod(index, TILES)
+    side, sector = divmod(side_sector, SECTORS)
+    return (SIDES[side], sector, tile)
+
+class MappingIndex:
+    '''
+    Dense lookup tables between tiles and readout channels.
+
+    forward[tile_index(side, sector, tile)] is the TrimMap index of the
+    channel reading out the tile, and inverse[TrimMap.index(side, ib,
+    channel)] is the tile index read out by the channel.  Missing entries
+    are UNMAPPED.
+
+    Parameters:
+        forward: array - Channel index of every tile.
+        inverse: array - Tile index of every channel.
+        errors: list - Problems found while building the index.
+    '''
+    def __init__(self, forward: array.array, inverse: array.array, errors: list = None):
+        self.forward = forward
+        self.inverse = inverse
+        self.errors = errors if errors is not None else []
+
+    def channel(self, side: str, sector: int, tile: int) -> tuple:
+        '''
+        Return the (side, ib, channel) reading out a tile, or None.
+        '''
+        k = self.forward[tile_index(side, sector, tile)]
+        return None if k == UNMAPPED else TrimMap.location(k)
+
+    def tile(self, side: str, ib: int, channel: int) -> tuple:
+        '''
+        Return the (side, sector, tile) read out by a channel, or None.
+        '''
+        t = self.inverse[TrimMap.index(side, ib, channel)]
+        return None if t == UNMAPPED else tile_location(t)
+
+    def to_dict(self) -> dict:
+        '''
+        Return the mapping in the nested side/sector/tile layout of
+        MakeTwelvePatternFiles.load_mapping.
+        '''
+        mapping = {}
+        for t, k in enumerate(self.forward):
+            if k != UNMAPPED:
+                side, sector, tile = tile_location(t)
+                mapping.setdefault(side, {}).setdefault(sector, {})[tile] = TrimMap.location(k)
+        return mapping
+
+    @classmethod
+    def from_csv(cls, file: str) -> 'MappingIndex':
+        '''
+        Parse the mapping CSV and check it for duplicate or missing tiles and
+        channels.
+
+        Parameters:
+            file: str - The mapping file.
+
+        Returns:
+            MappingIndex - The index.  Problems are listed in errors.
+        '''
+        forward = array.array('h', [UNMAPPED] * N_TILES)
+        inverse = array.array('h', [UNMAPPED] * N_CHANNELS)
+        errors = []
+        with open(file, 'r') as f:
+            next(f)  # Skip the first line of the file
+            for line_number, line in enumerate(f, 2):
+                if not line.strip():
+                    continue
+                try:
+                    side, sector, tile, _, _, _, ib, channel = line.strip().split(',')
+                    side = side.strip().upper()
+                    sector = int(sector)
+                    tile = int(tile)
+                    ib = int(ib)
+                    channel = int(channel)
+                    if side == 'S':
+                        ib -= 6
+                    if side not in SIDES or not (0 <= sector < SECTORS and 0 <= tile < TILES and TrimMap.valid(side, ib, channel)):
+                        raise ValueError('out of range')
+                    t = tile_index(side, sector, tile)
+                    k = TrimMap.index(side, ib, channel)
+                except ValueError as e:
+                    errors.append(f'Line {line_number}: invalid entry ({e}): {line.strip()}')
+                    continue
+                # the first entry for a tile or channel wins
+                if forward[t] != UNMAPPED:
+                    errors.append(f'Line {line_number}: duplicate tile Side={side}, Sector={sector}, Tile={tile}')
+                    continue
+                if inverse[k] != UNMAPPED:
+                    errors.append(f'Line {line_number}: channel Side={side}, IB={ib}, I={channel} already maps to tile {tile_location(inverse[k])}')
+                    continue
+                forward[t] = k
+                inverse[k] = t
+        for t in [t for t, k in enumerate(forward) if k == UNMAPPED]:
+            side, sector, tile = tile_location(t)
+            errors.append(f'Missing tile Side={side}, Sector={sector}, Tile={tile}')
+        return cls(forward, inverse, errors)
+
+    def tobytes(self, digest: bytes) -> bytes:
+        '''
+        Serialize the index for the cache.
+        '''
+        return CACHE_HEADER.pack(CACHE_MAGIC, sys.byteorder[0].encode(), digest) + self.forward.tobytes() + self.inverse.tobytes()
+
+    @classmethod
+    def frombytes(cls, data: bytes, digest: bytes) -> 'MappingIndex':
+        '''
+        Load an index from the cache, or return None if the cache does not
+        match this machine or the digest of the source file.
+        '''
+        if len(data) != CACHE_HEADER.size + 2 * (N_TILES + N_CHANNELS):
+            return None
+        magic, byteorder, cached_digest = CACHE_HEADER.unpack_from(data)
+        if magic != CACHE_MAGIC or byteorder != sys.byteorder[0].encode() or cached_digest != digest:
+            return None
+        forward = array.array('h')
+        forward.frombytes(data[CACHE_HEADER.size:CACHE_HEADER.size + 2 * N_TILES])
+        inverse = array.array('h')
+        inverse.frombytes(data[CACHE_HEADER.size + 2 * N_TILES:])
+        return cls(forward, inverse)
+
+    @classmethod
+    def load(cls, file: str, cache_file: str = None) -> 'MappingIndex':
+        '''
+        Load the mapping, from the precompiled cache if it was built from the
+        current contents of the file, and from the CSV otherwise.  The cache
+        is only written for a mapping without errors.
+
+        Parameters:
+            file: str - The mapping file.
+            cache_file: str - The cache file.  Defaults to the mapping file
+                              with .idx appended.
+
+        Returns:
+            MappingIndex - The index.
+        '''
+        if cache_file is None:
+            cache_file = file + '.idx'
+        with open(file, 'rb') as f:
+            digest = hashlib.sha256(f.read()).digest()
+        if os.path.exists(cache_file):
+            with open(cache_file, 'rb') as f:
+                index = cls.frombytes(f.read(), digest)
+            if index is not None:
+                return index
+            logging.info(f'Mapping cache {cache_file} is out of date, rebuilding')
+
+        index = cls.from_csv(file)
+        for error in index.errors:
+            logging.warning(f'Mapping {file}: {error}')
+        if not index.errors:
+            try:
+                write_atomic(cache_file, index.tobytes(digest))
+            except OSError as e:
+                logging.warning(f'Could not write mapping cache {cache_file}: {e}')
+        return index
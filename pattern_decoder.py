@@ -0,0 +1,211 @@
+#! /usr/bin/python3
+
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+
+import config
+from mapping_index import MappingIndex, N_TILES, UNMAPPED, tile_location
+from MakeTwelvePatternFiles import ALL_TILES, PATTERNS
+from trim_map import TrimMap, SIDES, N_CHANNELS
+
+ALL_CHANNELS = (1 << N_CHANNELS) - 1
+
+def channel_mask(states) -> int:
+    '''
+    Pack per-channel on/off states into an int with bit k set for every
+    channel k (in TrimMap order) that is on.
+    '''
+    return int(''.join('1' if state else '0' for state in reversed(list(states))), 2)
+
+def same_point(key: str, point: str) -> bool:
+    '''
+    Return True if a point of a reduced file is the requested one, comparing
+    voltages as numbers.
+    '''
+    if key == point:
+        return True
+    try:
+        return float(key) == float(point)
+    except ValueError:
+        return False
+
+def read_states(file_name: str, threshold: float = None, point: str = None) -> int:
+    '''
+    Read the measured response of every channel to a pattern.
+
+    The file is either reduced by sEPD_gain_matching.py (JSON with the
+    per-channel 'mip_counts' of every voltage or pattern file), or text with
+    'side ib channel counts' on every line.
+
+    Parameters:
+        file_name: str - The file.
+        threshold: float - Fewest counts above config.MIP_THRESHOLD for a
+                           channel to be on.  Defaults to
+                           config.PATTERN_ON_THRESHOLD.
+        point: str - The voltage or pattern file of the reduced point to
+                     use.  Only needed if the file has more than one.
+
+    Returns:
+        int - The channel mask of the channels that are on.
+    '''
+    if threshold is None:
+        threshold = config.PATTERN_ON_THRESHOLD
+    if file_name.endswith('.json'):
+        with open(file_name, 'r') as f:
+            reduced = json.load(f)
+        if point is None and len(reduced) == 1:
+            point = next(iter(reduced))
+        keys = [key for key in reduced if point is not None and same_point(key, point)]
+        if not keys:
+            raise ValueError(f'{file_name} has points {list(reduced)}, select one with --point')
+        counts = reduced[keys[0]]['mip_counts']
+    else:
+        counts = [0.0] * N_CHANNELS
+        with open(file_name, 'r') as f:
+            for line in f:
+                line_info = line.split()
+                if len(line_info) == 4 and line_info[0] in SIDES:
+                    side, ib, channel, value = line_info
+                    if not TrimMap.valid(side, int(ib), int(channel)):
+                        raise ValueError(f'{file_name} has an invalid channel: Side={side}, IB={ib}, I={channel}')
+                    counts[TrimMap.index(side, int(ib), int(channel))] = float(value)
+    return channel_mask(count >= threshold for count in counts)
+
+def expected_states(mask: int, mapping: MappingIndex) -> int:
+    '''
+    Return the channel mask of the channels that should be on when the
+    tiles in mask are off.
+    '''
+    return channel_mask(tile != UNMAPPED and not mask >> tile & 1 for tile in mapping.inverse)
+
+def transpose(masks: list, width: int) -> list:
+    '''
+    Turn one mask per pattern into one code per bit position, with bit p
+    of code k taken from bit k of masks[p].
+    '''
+    rows = [bin(mask)[2:].zfill(width)[::-1] for mask in masks]
+    return [int(''.join(reversed(column)), 2) for column in zip(*rows)]
+
+def decode(measured: dict, mapping: MappingIndex, patterns: dict = None) -> dict:
+    '''
+    Check the mapping against the measured response to a set of patterns.
+
+    Each pattern is compared to its expectation for every channel at once
+    with bitwise operations.  The on/off states of each channel across the
+    patterns form a code that identifies the tile it is wired to, so
+    miswired channels are decoded back to their actual tile.
+
+    Parameters:
+        measured: dict - The channel mask of the channels that were on, by
+                         pattern.
+        mapping: MappingIndex - The mapping to check.
+        patterns: dict - The mask of tiles turned off in each pattern.
+                         Defaults to MakeTwelvePatternFiles.PATTERNS.
+
+    Returns:
+        dict - 'dead': channels never on; 'stuck_on': channels on in every
+               pattern although some turned them off; 'swapped': (channel,
+               expected tile, measured tile) of every channel reading out
+               another tile; 'unknown': other channels whose response
+               matches no tile; 'decoded': the measured tile of every
+               channel, UNMAPPED if unknown.
+    '''
+    if patterns is None:
+        patterns = PATTERNS
+    order = sorted(measured)
+    missing = [name for name in order if name not in patterns]
+    if missing:
+        raise ValueError(f'Unknown patterns: {missing}')
+
+    mapped = channel_mask(tile != UNMAPPED for tile in mapping.inverse)
+    mismatch = 0
+    ever_on = 0
+    always_on = ALL_CHANNELS
+    ever_off_expected = 0
+    for name in order:
+        expected = expected_states(patterns[name], mapping)
+        mismatch |= measured[name] ^ expected
+        ever_on |= measured[name]
+        always_on &= measured[name]
+        ever_off_expected |= mapped & ~expected
+    dead = mapped & ~ever_on
+    stuck_on = always_on & ever_off_expected
+
+    # the code of every tile is whether it is on in each pattern
+    tile_codes = transpose([ALL_TILES & ~patterns[name] for name in order], N_TILES)
+    tiles_by_code = {}
+    for tile, code in enumerate(tile_codes):
+        tiles_by_code.setdefault(code, []).append(tile)
+    channel_codes = transpose([measured[name] for name in order], N_CHANNELS)
+
+    report = {'dead': [], 'stuck_on': [], 'swapped': [], 'unknown': [], 'decoded': []}
+    for k, code in enumerate(channel_codes):
+        tiles = tiles_by_code.get(code, [])
+        report['decoded'].append(tiles[0] if len(tiles) == 1 else UNMAPPED)
+        if not mismatch >> k & 1:
+            continue
+        if dead >> k & 1:
+            report['dead'].append(k)
+        elif stuck_on >> k & 1:
+            report['stuck_on'].append(k)
+        elif len(tiles) == 1:
+            report['swapped'].append((k, mapping.inverse[k], tiles[0]))
+        else:
+            report['unknown'].append(k)
+    return report
+
+def describe_tile(tile: int) -> str:
+    if tile == UNMAPPED:
+        return 'no tile'
+    side, sector, tile = tile_location(tile)
+    return f'Side={side}, Sector={sector}, Tile={tile}'
+
+def describe_channel(k: int) -> str:
+    side, ib, channel = TrimMap.location(k)
+    return f'Side={side}, IB={ib}, I={channel}'
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Check the sEPD mapping against the measured response to the check patterns')
+    parser.add_argument('--pattern', metavar=('number', 'file_name'), nargs=2, action='append', default=[], help='Measured response to a pattern from MakeTwelvePatternFiles (repeat for every pattern)')
+    parser.add_argument('--sequence', metavar='file_name', type=str, help='Reduced pattern sequence (sEPD_gain_matching.py on the pattern_sequence file from sEPD_bias_scan.py --sequence), giving the response to every pattern_<number> file in it')
+    parser.add_argument('--mapping', metavar='file_name', type=str, default=config.MAPPING_FILE, help='Mapping file to check')
+    parser.add_argument('--point', metavar='voltage_or_file', type=str, help='Point to use from reduced files with more than one')
+    parser.add_argument('--threshold', metavar='counts', type=float, help='Fewest counts above the MIP threshold for a channel to be on')
+    parser.add_argument('--log', metavar='log_level', type=str, default='INFO', help='Set the logging level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'])
+    args = parser.parse_args(argv[1:])
+    logging.basicConfig(level=getattr(logging, args.log))
+
+    if not args.pattern and not args.sequence:
+        parser.error('give --pattern or --sequence')
+
+    mapping = MappingIndex.load(args.mapping)
+    measured = {int(number): read_states(file_name, args.threshold, args.point) for number, file_name in args.pattern}
+    if args.sequence:
+        with open(args.sequence, 'r') as f:
+            points = list(json.load(f))
+        for point in points:
+            match = re.fullmatch(r'pattern_(\d+)', os.path.splitext(os.path.basename(point))[0])
+            if match:
+                measured[int(match.group(1))] = read_states(args.sequence, args.threshold, point)
+            else:
+                logging.warning(f'{point} is not a pattern_<number> file, skipping')
+    report = decode(measured, mapping)
+
+    for k in report['dead']:
+        logging.warning(f'Dead channel: {describe_channel(k)}, mapped to {describe_tile(mapping.inverse[k])}')
+    for k in report['stuck_on']:
+        logging.warning(f'Stuck on channel: {describe_channel(k)}, mapped to {describe_tile(mapping.inverse[k])}')
+    for k, expected, actual in report['swapped']:
+        logging.warning(f'Miswired channel: {describe_channel(k)}, mapped to {describe_tile(expected)}, reads out {describe_tile(actual)}')
+    for k in report['unknown']:
+        logging.warning(f'Unrecognized response: {describe_channel(k)}, mapped to {describe_tile(mapping.inverse[k])}')
+    problems = sum(len(report[key]) for key in ('dead', 'stuck_on', 'swapped', 'unknown'))
+    logging.info(f'{len(measured)} patterns, {problems} problem channels')
+    sys.exit(1 if problems else 0)
+
+if __name__ == '__main__':
+    main(sys.argv)
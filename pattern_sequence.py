@@ -0,0 +1,92 @@
+from trim_map import TrimMap, N_CHANNELS
+
+# Cost of changing a board voltage, in channel changes.  A new bias map
+# means loading it and waiting for the supplies to settle, which takes
+# longer than resending every trim.
+BIAS_CHANGE_COST = N_CHANNELS
+
+def distance(a: TrimMap, b: TrimMap) -> int:
+    '''
+    Return the cost of going from one set of trim voltages to another: the
+    number of channels that change plus BIAS_CHANGE_COST for every board
+    voltage that changes.
+    '''
+    return len(a.diff(b)) + BIAS_CHANGE_COST * sum(1 for x, y in zip(a.biases, b.biases) if x != y)
+
+def path_cost(order: list, costs: list) -> int:
+    return sum(costs[i][j] for i, j in zip(order, order[1:]))
+
+def nearest_neighbour(first: int, costs: list) -> list:
+    '''
+    Build a path from the first node by always moving to the cheapest
+    node not visited yet.
+    '''
+    order = [first]
+    remaining = set(range(len(costs))) - {first}
+    while remaining:
+        last = order[-1]
+        nearest = min(remaining, key=lambda n: (costs[last][n], n))
+        order.append(nearest)
+        remaining.remove(nearest)
+    return order
+
+def two_opt(order: list, costs: list) -> list:
+    '''
+    Improve an open path by reversing segments while that makes it cheaper.
+    The first node stays in place.
+    '''
+    order = list(order)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, len(order) - 1):
+            for j in range(i + 1, len(order)):
+                # reversing order[i:j + 1] replaces the edges into order[i]
+                # and out of order[j]
+                before = costs[order[i - 1]][order[i]]
+                after = costs[order[i - 1]][order[j]]
+                if j + 1 < len(order):
+                    before += costs[order[j]][order[j + 1]]
+                    after += costs[order[i]][order[j + 1]]
+                if after < before:
+                    order[i:j + 1] = reversed(order[i:j + 1])
+                    improved = True
+    return order
+
+def order_patterns(patterns: dict, start: TrimMap = None) -> list:
+    '''
+    Order a set of patterns so that going through them changes as few
+    channels as possible.
+
+    The order is built by nearest neighbour and then improved with 2-opt
+    moves.  Patterns differing in few channels end up next to each other,
+    so bit-plane patterns come out in a Gray-code-like order.
+
+    Parameters:
+        patterns: dict - The TrimMap of every pattern, by name.
+        start: TrimMap - Optional trim voltages loaded before the first
+                         pattern.  Without it the path may start at any
+                         pattern.
+
+    Returns:
+        list - The pattern names, in order.
+    '''
+    names = list(patterns)
+    if len(names) < 2 and start is None:
+        return names
+    maps = [patterns[name] for name in names]
+    if start is not None:
+        maps.insert(0, start)
+    costs = [[distance(a, b) for b in maps] for a in maps]
+
+    if start is not None:
+        order = two_opt(nearest_neighbour(0, costs), costs)[1:]
+        return [names[n - 1] for n in order]
+
+    # With a free start, the path is as good as its best first pattern
+    best = None
+    for first in range(len(maps)):
+        order = two_opt(nearest_neighbour(first, costs), costs)
+        if best is None or path_cost(order, costs) < path_cost(best, costs):
+            best = order
+    return [names[n] for n in best]
@@ -0,0 +1,158 @@
+import array
+import hashlib
+import logging
+import os
+import struct
+import sys
+import zlib
+
+import config
+from bias_map import write_atomic
+from trim_map import N_CHANNELS
+
+CACHE_EXTENSION = '.sum'
+CACHE_MAGIC = b'SEPDSUMM'
+CACHE_FORMAT_VERSION = 1
+
+# Header: magic, format version, number of channels, number of columns,
+# number of events, crc32 of the payload, padding to 32 bytes.  The payload
+# follows: one little endian float64 column of N_CHANNELS values per column.
+HEADER = struct.Struct('<8sIHHQI4x')
+
+def file_key(file_name: str, version: str, content_hash: bool = False) -> str:
+    '''
+    Return the cache key of a data file.
+
+    Parameters:
+        file_name: str - The data file.
+        version: str - Version of the code producing the cached results.
+                       Results from other versions are never returned.
+        content_hash: bool - If True, key on the contents of the file.
+                             Otherwise key on its path, size and
+                             modification time, which needs no read.
+
+    Returns:
+        str - The key.
+    '''
+    key = hashlib.sha256(version.encode())
+    if content_hash:
+        with open(file_name, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                key.update(block)
+    else:
+        stat = os.stat(file_name)
+        key.update(f'{os.path.abspath(file_name)}|{stat.st_size}|{stat.st_mtime_ns}'.encode())
+    return key.hexdigest()
+
+class RunCache:
+    '''
+    A folder of per-run channel summaries, keyed by file_key.
+
+    Each entry holds the number of events and a fixed set of per-channel
+    columns in a small binary file.  Reading an entry marks it as used, and
+    the least recently used entries are removed once the folder grows past
+    max_bytes.
+
+    Parameters:
+        columns: tuple - The names of the per-channel columns.
+        version: str - Version of the code producing the summaries.
+        folder: str - The cache folder.  Defaults to config.CACHE_FOLDER.
+        max_bytes: int - Size limit of the folder.  Defaults to
+                         config.CACHE_MAX_BYTES.
+        content_hash: bool - Key entries on file contents.  See file_key.
+    '''
+    def __init__(self, columns: tuple, version: str, folder: str = None, max_bytes: int = None, content_hash: bool = False):
+        self.columns = tuple(columns)
+        self.version = f'{version}|{",".join(self.columns)}'
+        self.folder = config.CACHE_FOLDER if folder is None else folder
+        self.max_bytes = config.CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.content_hash = content_hash
+        os.makedirs(self.folder, exist_ok=True)
+
+    def path(self, file_name: str) -> str:
+        return os.path.join(self.folder, file_key(file_name, self.version, self.content_hash) + CACHE_EXTENSION)
+
+    def get(self, file_name: str) -> dict:
+        '''
+        Return the cached summary of a data file, or None.
+
+        Parameters:
+            file_name: str - The data file.
+
+        Returns:
+            dict - The number of events and every column as a list.
+        '''
+        try:
+            path = self.path(file_name)
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if len(data) != HEADER.size + 8 * N_CHANNELS * len(self.columns):
+            logging.warning(f'Ignoring malformed cache entry {path}')
+            return None
+        magic, version, n_channels, n_columns, events, crc = HEADER.unpack_from(data)
+        if magic != CACHE_MAGIC or version != CACHE_FORMAT_VERSION or n_channels != N_CHANNELS \
+                or n_columns != len(self.columns) or zlib.crc32(data[HEADER.size:]) != crc:
+            logging.warning(f'Ignoring malformed cache entry {path}')
+            return None
+        values = array.array('d', data[HEADER.size:])
+        if sys.byteorder == 'big':
+            values.byteswap()
+        # mark the entry as recently used
+        os.utime(path)
+        summary = {'events': events}
+        for n, column in enumerate(self.columns):
+            summary[column] = values[n * N_CHANNELS:(n + 1) * N_CHANNELS].tolist()
+        return summary
+
+    def put(self, file_name: str, summary: dict) -> None:
+        '''
+        Store the summary of a data file and evict old entries.  The entry
+        is written atomically.
+
+        Parameters:
+            file_name: str - The data file.
+            summary: dict - The number of events and every column.  Other
+                            keys are not stored.
+
+        Returns:
+            None
+        '''
+        values = array.array('d')
+        for column in self.columns:
+            values.extend(summary[column])
+        if len(values) != N_CHANNELS * len(self.columns):
+            raise ValueError(f'Summary columns must have {N_CHANNELS} values')
+        if sys.byteorder == 'big':
+            values.byteswap()
+        payload = values.tobytes()
+        path = self.path(file_name)
+        header = HEADER.pack(CACHE_MAGIC, CACHE_FORMAT_VERSION, N_CHANNELS, len(self.columns), summary['events'], zlib.crc32(payload))
+        write_atomic(path, header + payload)
+        self.evict()
+
+    def evict(self) -> int:
+        '''
+        Remove the least recently used entries until the folder fits in
+        max_bytes.
+
+        Returns:
+            int - The number of entries removed.
+        '''
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith(CACHE_EXTENSION):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            removed += 1
+        if removed:
+            logging.debug(f'Evicted {removed} cache entries from {self.folder}')
+        return removed
@@ -1,17 +1,36 @@
 #! /usr/bin/python3
 
+import asyncio
 import datetime
 import os
-import subprocess
+import socket
+import shutil
 import sys
 import time
 import json
 import telnetlib
 import argparse
+import array
+import glob
+import re
 import logging
+import collections
+import concurrent.futures
 
 import config
+import timing
+from bias_map import INSTALLED_NAME, install_bias_map, load_template, render_bias_maps
+from daemon_client import DaemonClient
+from daq_control import DAQControl
+from mapping_index import MappingIndex
+from pattern_sequence import order_patterns
+from scan_journal import ScanJournal, find_unfinished_journal
+from trim_snapshot import SNAPSHOT_EXTENSION, SnapshotError, is_snapshot, read_snapshot, write_snapshot
+from trim_history import TrimHistory, parse_timestamp, record_snapshot
+from trim_map import TrimMap, SIDES, N_BOARDS, N_CHANNELS
+from trim_ramp import ramp_schedule
 
+@timing.timed('file.bias_map_write')
 def generate_bias_map(voltages: list) -> str:
     '''
     Generates the bias map for a particular voltage.
@@ -19,20 +38,15 @@ def generate_bias_map(voltages: list) -> str:
 
     Parameters:
         voltage: list - The list of voltage to generate the bias map
-                        for.  The list should be 6 elements long.
+                        for.  The list should be 12 elements long.
 
     Returns:
-        str - The file name of the bias map.
+        str - The file name of the bias map, named after its contents (see
+              bias_map.render_bias_maps).
     '''
-    lines = []
-    with open('sEPD_HVSet_template.txt', 'r') as f:
-        lines = f.readlines()
-    file_name = os.path.join(config.BIAS_MAPS_FOLDER, f'sEPD_HVSet_{config.TIMESTAMP}.txt')
-    with open(file_name, 'w') as f:
-        for i, line in enumerate(lines):
-            f.write(line.format(voltages[i]))
-    return file_name
+    return render_bias_maps([voltages])[0]
 
+@timing.timed('bias_map.load')
 def load_bias_map(file_name: str) -> None:
     '''
     Load the bias map into the bias control system.
@@ -43,305 +57,960 @@ def load_bias_map(file_name: str) -> None:
     Returns:
         None
     '''
-    # move the file to the bias control folder
-    os.rename(file_name, os.path.join(config.BIAS_CONTROL_FOLDER, 'sEPD_HVSet.txt'))
+    # copy the file to the bias control folder, keeping it as a record
+    install_bias_map(file_name)
     # load the bias map
     # subprocess.run(['bash', os.path.join(config.BIAS_CONTROL_FOLDER, 'sEPD_Init.sh')])
     # Wait for bias supply to stabilize
     # time.sleep(1)
     print(f'Bias map loaded to {os.path.join(config.BIAS_CONTROL_FOLDER, 'sEPD_HVSet.txt')}.  Run sEPD_init.sh to load the bias map.')
 
-def record_events(n_events: int, ) -> dict:
+@timing.timed('daq.record')
+def record_events(n_events: int, settle: float = 0.0) -> dict:
     '''
     Take a run with n events.
 
+    Runs are only taken if config.DAQ_ENABLED is set, through
+    DAQControl.record.  Otherwise this waits for the bias supplies and
+    returns no run information.
+
     Parameters:
         n_events: int - The number of events to record.
-        test: bool - If True, simulate running the DAQ.
+        settle: float - Seconds to wait for the bias supplies before the
+                        run starts.  The SEB is initialized meanwhile.
 
     Returns:
         dict - Information about the run.
     '''
     run_info = {}
-    return run_info # SHORT CIRCUIT EVERYTHING.  No longer running in this mode
+    if not config.DAQ_ENABLED:
+        time.sleep(settle)
+        return run_info
     if config.SIMULATE:
         run_info['run_number'] = 1
         run_info['file_path'] = 'test_file_path'
         run_info['num_events'] = n_events
         return run_info
 
-    subprocess.run(['jseb2client', 'init', config.SEB])
-    
-    # Start run 
-    logging.info('Starting run')
-    run_number = subprocess.check_output(['rcdaq_client', 'daq_begin']).split()[3]
-    run_number = int(run_number)
-    run_info['run_number'] = run_number
-
-    subprocess.run(['gl1_gtm_client', 'gtm_startrun', config.VGTM])
-    # Run until desired number of events are collected
-    while (int(subprocess.check_output(['rcdaq_client', 'daq_get_numberevents'])) < n_events):
-        time.sleep(5)
-    
-    # Stop run
-    logging.info('Stopping run')
-    subprocess.run(['gl1_gtm_client', 'gtm_stop', config.VGTM])
-    subprocess.run(['rcdaq_client', 'daq_end'])
-    time.sleep(0.5)
-    file_name = subprocess.check_output(['rcdaq_client', 'daq_get_lastfilename']).decode()
-    run_info['file_path'] = str(file_name).strip()
-    number_events = subprocess.check_output(['rcdaq_client', 'daq_get_last_event_number'])
-    run_info['num_events'] = int(number_events)
-    return run_info
-    
-def run_scans(voltages: list) -> dict:
+    return asyncio.run(DAQControl().record(n_events, settle))
+
+def backup_bias_map(file_name: str) -> None:
+    '''
+    Copy the installed bias map.  Exits if it cannot be copied, before
+    anything is changed that it would be needed to restore.
+
+    Parameters:
+        file_name: str - The backup file.
+    '''
+    installed = os.path.join(config.BIAS_CONTROL_FOLDER, INSTALLED_NAME)
+    try:
+        shutil.copyfile(installed, file_name)
+    except OSError as e:
+        logging.critical(f'Error: could not back up the bias map {installed}: {e}')
+        sys.exit(1)
+
+def run_scans(voltages: list = None, n_events: int = 1000, resume: str = None, controller: 'BiasController' = None) -> dict:
     '''
     Run the bias scan for a list of voltages.
 
+    The bias maps of all points are rendered before the first run, so only
+    installing a map and letting the supplies settle happen between runs.
+    Every finished point is appended to a scan journal in run_info as soon
+    as it finishes, and the original bias map is restored however the scan
+    ends.
+
     Parameters:
         voltages: list - A list of voltages to scan.
+        n_events: int - The number of events to record at each voltage.
+        resume: str - Optional journal of an unfinished scan.  Its
+                      voltages and settings are used, finished points are
+                      skipped, and its backup bias map is restored.
+        controller: BiasController - Optional session used to record the
+                                     loaded trim voltages in the journal.
 
     Returns:
         dict - Information about the scans.
     '''
-    # Backup the current bias map with timestamp
-    backup_file_name = f'sEPD_HVSet_backup_{config.TIMESTAMP}.txt'
-    logging.info(f'Backing up current bias map to {backup_file_name}')
-    subprocess.run(['cp', os.path.join(config.BIAS_CONTROL_FOLDER, 'sEPD_HVSet.txt'), os.path.join(config.BIAS_MAPS_FOLDER, backup_file_name)])
+    if resume:
+        journal = ScanJournal(resume)
+        start = journal.start
+        if start is None:
+            logging.critical(f'Error: {resume} does not record the start of a scan')
+            sys.exit(1)
+        voltages = start['voltages']
+        n_events = start['n_events']
+        backup_file_name = start['backup_bias_map']
+        trim_snapshot = start['trim_snapshot']
+        if not os.path.exists(backup_file_name):
+            logging.critical(f'Error: the backup bias map {backup_file_name} of {resume} is missing')
+            sys.exit(1)
+        scan_info = {step['voltage']: step['run_info'] for step in journal.steps}
+        logging.info(f'Resuming scan from {resume}: {len(journal.completed_voltages())} of {len(voltages)} points already done')
+    else:
+        # Backup the current bias map with timestamp
+        backup_file_name = os.path.join(config.BIAS_MAPS_FOLDER, f'sEPD_HVSet_backup_{config.TIMESTAMP}.txt')
+        logging.info(f'Backing up current bias map to {backup_file_name}')
+        backup_bias_map(backup_file_name)
 
-    scan_info = {}
-    for voltage in voltages:
-        voltage = float(voltage)
-        bias_map = generate_bias_map(voltage)
-        load_bias_map(bias_map)
-        scan_info[voltage] = record_events(1000)
+        trim_snapshot = None
+        if controller is not None:
+            trim_snapshot = os.path.join(config.BIAS_MAPS_FOLDER, f'trim_voltages_{config.TIMESTAMP}{SNAPSHOT_EXTENSION}')
+            write_snapshot(trim_snapshot, get_loaded_voltages(controller))
+
+        voltages = [float(voltage) for voltage in voltages]
+        journal = ScanJournal(os.path.join('run_info', f'scan_journal_{config.TIMESTAMP}.jsonl'))
+        journal.append({'type': 'start', 'voltages': voltages, 'n_events': n_events,
+                        'backup_bias_map': backup_file_name, 'trim_snapshot': trim_snapshot})
+        scan_info = {}
+
+    completed = set(journal.completed_voltages())
+    remaining = [voltage for voltage in voltages if voltage not in completed]
+    bias_maps = render_bias_maps([[voltage] * N_BOARDS for voltage in remaining])
+    # the trims stay as they were for the whole scan
+    step_map = read_snapshot(trim_snapshot)[0] if trim_snapshot else None
+    try:
+        for voltage, bias_map in zip(remaining, bias_maps):
+            load_bias_map(bias_map)
+            scan_info[voltage] = record_events(n_events, settle=config.BIAS_SETTLE_TIME)
+            journal.append({'type': 'step', 'voltage': voltage, 'run_info': scan_info[voltage],
+                            'biases': [voltage] * N_BOARDS, 'bias_map': bias_map, 'trim_snapshot': trim_snapshot})
+            if step_map is not None:
+                step_map.set_biases(voltage)
+                record_snapshot(step_map, 'scan_step', source=journal.file_name,
+                                details={'voltage': voltage, 'run_info': scan_info[voltage], 'bias_map': bias_map})
+    finally:
+        # Restore the backup bias map, keeping a copy
+        logging.info(f'Restoring backup bias map')
+        install_bias_map(backup_file_name)
+        if step_map is not None:
+            record_snapshot(TrimMap(step_map.trims, read_bias_map(backup_file_name)), 'restore', source=backup_file_name)
 
     # Save scan info to JSON file
+    scan_info = {voltage: scan_info[voltage] for voltage in voltages}
     with open(f'run_info/scan_info_{config.TIMESTAMP}.json', 'w') as f:
         json.dump(scan_info, f, indent=4)
-
-    # Restore the backup bias map, keeping a copy
-    logging.info(f'Restoring backup bias map')
-    subprocess.run(['cp', os.path.join(config.BIAS_MAPS_FOLDER, backup_file_name), os.path.join(config.BIAS_CONTROL_FOLDER, 'sEPD_HVSet.txt')])
+    timing_file = timing.write_summary(f'run_info/scan_info_{config.TIMESTAMP}_timing.json')
+    journal.append({'type': 'end', 'scan_info': f'run_info/scan_info_{config.TIMESTAMP}.json', 'timing': timing_file})
 
     return scan_info
 
-def send_command(tn: telnetlib.Telnet, command: str) -> str:
+class BiasControlError(Exception):
+    '''
+    Raised when the bias control system fails to answer a command or
+    answers with an error.
+    '''
+    pass
+
+def unanswered(commands: list, first: int, sent: int) -> str:
+    '''
+    Describe the commands from first to sent - 1, which have no reply yet.
+    '''
+    if sent - first == 1:
+        return f'command {first} ({commands[first].strip()})'
+    return f'commands {first}..{sent - 1} ({commands[first].strip()} to {commands[sent - 1].strip()})'
+
+def send_commands(tn: telnetlib.Telnet, commands: list, max_in_flight: int = None, timeout: float = None) -> list:
     '''
-    Send a command to the bias control system and return the response.
+    Send a list of commands to the bias control system without waiting for
+    each response before sending the next one.  Up to max_in_flight commands
+    are written back to back, and the '>' prompts are matched to the commands
+    in the order they were sent.
 
     Parameters:
         tn: telnetlib.Telnet - The telnet connection to the bias control system.
-        command: str - The command to send.
+        commands: list - The commands to send.
+        max_in_flight: int - The maximum number of unanswered commands.
+                             Defaults to config.MAX_IN_FLIGHT.
+        timeout: float - Seconds to wait for each prompt.  Defaults to
+                         config.COMMAND_TIMEOUT.
 
     Returns:
-        str - The response from the bias control system.
+        list - The responses, one per command.
+
+    Raises:
+        BiasControlError - If a command fails, times out or the connection
+                           is closed.  Since a lost prompt shifts every later
+                           prompt onto the wrong command, timeouts name all
+                           the commands still waiting for a reply.
     '''
-    logging.debug(f'Sending command: {command}')
-    tn.write(command.encode('ascii') + b'\n')
-    response = tn.read_until(b'>').decode('ascii')
-    logging.debug(f'Response: {response}')
-    return response
+    if max_in_flight is None:
+        max_in_flight = config.MAX_IN_FLIGHT
+    if timeout is None:
+        timeout = config.COMMAND_TIMEOUT
+    max_in_flight = max(1, max_in_flight)
+    # Send times of the commands in flight, if timing is enabled
+    send_times = collections.deque() if timing.enabled else None
+
+    responses = []
+    sent = 0
+    while len(responses) < len(commands):
+        # Top up the window
+        while sent < len(commands) and sent - len(responses) < max_in_flight:
+            logging.debug(f'Sending command: {commands[sent]}')
+            if send_times is not None:
+                send_times.append(time.perf_counter())
+            tn.write(commands[sent].encode('ascii') + b'\n')
+            sent += 1
+        index = len(responses)
+        try:
+            response = tn.read_until(b'>', timeout).decode('ascii')
+        except EOFError:
+            raise BiasControlError(f'Connection closed while waiting for {unanswered(commands, index, sent)}')
+        if not response.endswith('>'):
+            raise BiasControlError(f'Timed out after {timeout} s waiting for {unanswered(commands, index, sent)}')
+        if 'ERR' in response:
+            raise BiasControlError(f'Command {index} ({commands[index].strip()}) failed: {response.rstrip(">").strip()}')
+        if send_times is not None:
+            timing.record('controller.command', time.perf_counter() - send_times.popleft())
+        logging.debug(f'Response: {response}')
+        responses.append(response)
+    return responses
 
-def read_trim_voltage_file(file_name: str) -> tuple:
+@timing.timed('file.trim_read')
+def read_trim_voltage_file(file_name: str) -> TrimMap:
     '''
-    Read the trim voltage file and return the contents as a dictionary.
+    Read the trim voltage file.  Binary snapshots are recognized and read
+    as well.
 
     Parameters:
         file_name: str - The file name of the trim voltage file.
 
     Returns:
-        dict - The contents of the trim voltage file.
+        TrimMap - The trim and board voltages in the file.
     '''
-    trim_voltages = {}
-    board_voltages = {}
+    trim_map = TrimMap()
+    seen_channels = bytearray(N_CHANNELS)
+    seen_boards = bytearray(N_BOARDS)
     # check if the file exists
     if not os.path.exists(file_name):
         logging.critical(f'Error: File {file_name} does not exist')
         sys.exit(1)
+    if is_snapshot(file_name):
+        try:
+            return read_snapshot(file_name)[0]
+        except SnapshotError as e:
+            logging.critical(f'Error: {e}')
+            sys.exit(1)
+    success = True
     with open(file_name, 'r') as f:
-        lines = f.readlines()
-    for line in lines[1:]: # skip the header
-        line_info = line.split()
-        if line_info[0] == 'CHANNEL':
-            _, side, ib, i, v = line_info
-            ib = int(ib)
-            i = int(i)
-            v = int(v)
-            if side not in trim_voltages:
-                trim_voltages[side] = {}
-            if ib not in trim_voltages[side]:
-                trim_voltages[side][ib] = {}
-            if i not in trim_voltages[side][ib]:
-                trim_voltages[side][ib][i] = v
+        next(f) # skip the header
+        for line in f:
+            line_info = line.split()
+            if not line_info:
+                continue
+            if line_info[0] == 'CHANNEL':
+                _, side, ib, i, v = line_info
+                if not TrimMap.valid(side, int(ib), int(i)):
+                    logging.error(f'Invalid channel: Side={side}, IB={ib}, I={i}')
+                    success = False
+                    continue
+                k = TrimMap.index(side, int(ib), int(i))
+                # the first entry for a channel wins
+                if not seen_channels[k]:
+                    trim_map.trims[k] = int(v)
+                    seen_channels[k] = 1
             elif line_info[0] == 'BOARD':
                 _, side, ib, v = line_info
-                ib = int(ib)
-                v = int(v)
-                if side not in board_voltages:
-                    board_voltages[side] = {}
-                board_voltages[side][ib] = v
-    # Check that all channels are present
-    success = True
-    for side in ['N', 'S']:
-        for ib in range(6):
-            for i in range(64):
-                if i not in trim_voltages[side][ib]:
-                    logging.error(f'Missing channel: Side={side}, IB={ib}, I={i}')
+                if not TrimMap.valid(side, int(ib)):
+                    logging.error(f'Invalid board: Side={side}, IB={ib}')
                     success = False
+                    continue
+                k = TrimMap.board_index(side, int(ib))
+                trim_map.biases[k] = float(v)
+                seen_boards[k] = 1
 
-    voltages = []
-    for side in ['N', 'S']:
-        for ib in range (6):
-            if ib not in board_voltages[side]:
-                logging.error(f'Missing board voltage: Side={side}, IB={ib}')
-                success = False
-            else:
-                voltages.append(board_voltages[side][ib])
+    # Check that all channels are present
+    for k in [k for k, seen in enumerate(seen_channels) if not seen]:
+        side, ib, i = TrimMap.location(k)
+        logging.error(f'Missing channel: Side={side}, IB={ib}, I={i}')
+        success = False
+    for side, ib in [TrimMap.boards()[k] for k, seen in enumerate(seen_boards) if not seen]:
+        logging.error(f'Missing board voltage: Side={side}, IB={ib}')
+        success = False
 
     if not success:
         logging.error('Trim voltage file is invalid.  Exiting.')
         sys.exit(1)
     
-    return (trim_voltages, voltages)
+    return trim_map
 
-def write_trim_voltage_file(file_name: str, trim_voltages: dict, biases: dict) -> None:
+@timing.timed('file.trim_write')
+def write_trim_voltage_file(file_name: str, trim_map: TrimMap) -> None:
     '''
-    Write the trim voltages to a file.
+    Write the trim voltages to a file.  A binary snapshot is written if the
+    file name ends in .snap.
 
     Parameters:
         file_name: str - The file name of the trim voltage file.
-        trim_voltages: dict - The trim voltages to write to the file.
+        trim_map: TrimMap - The trim and board voltages to write to the file.
 
     Returns:
         None
     '''
+    if file_name.endswith(SNAPSHOT_EXTENSION):
+        write_snapshot(file_name, trim_map)
+        return
+    lines = ['Side IB I Voltage\n'] # header
+    for b, (side, ib) in enumerate(TrimMap.boards()):
+        lines.append(f'BOARD {side} {ib} {trim_map.biases[b]}\n')
+        lines.extend(f'CHANNEL {side} {ib} {i} {v}\n' for i, v in enumerate(trim_map.trims[TrimMap.board_slice(b)]))
     with open(file_name, 'w') as f:
-        # print a header
-        f.write('Side IB I Voltage\n')
-        for side in ['N', 'S']:
-            for ib in trim_voltages[side]:
-                f.write(f'BOARD {side} {ib} {biases[side][ib]}\n')
-                for i in trim_voltages[side][ib]:
-                    v = trim_voltages[side][ib][i]
-                    f.write(f'CHANNEL {side} {ib} {i} {v}\n')
+        f.write(''.join(lines))
 
 def generate_empty_trim_file(base_voltage: float, file_name: str) -> None:
     '''
     Generate an empty trim voltage file.
 
     Parameters:
+        base_voltage: float - The bias voltage of every board.
         file_name: str - The file name of the trim voltage file.
 
     Returns:
         None
     '''
-    trim_voltages = {}
-    bias_voltages = {}
-    for side in ['N', 'S']:
-        trim_voltages[side] = {}
-        bias_voltages[side] = {}
-        for ib in range(6):
-            trim_voltages[side][ib] = {}
-            bias_voltages[side][ib] = base_voltage
-            for i in range(64):
-                trim_voltages[side][ib][i] = 0
-    write_trim_voltage_file(file_name, trim_voltages, bias_voltages)
-
-def get_trim_voltages() -> dict:
+    trim_map = TrimMap()
+    trim_map.set_biases(base_voltage)
+    write_trim_voltage_file(file_name, trim_map)
+
+def read_bias_map(file_name: str) -> list:
+    '''
+    Read the board voltages back from a bias map.
+
+    Parameters:
+        file_name: str - The file name of the bias map.
+
+    Returns:
+        list - The board voltages, in the order generate_bias_map takes them.
+    '''
+    with open(file_name, 'r') as f:
+        return load_template().parse(f.read())
+
+# Tile mapping, loaded on first use.  False if it is not available.
+mapping = None
+
+def channel_label(k: int) -> str:
+    '''
+    Describe a channel for log messages, including the tile it reads out if
+    the mapping file is available.
+
+    Parameters:
+        k: int - The TrimMap index of the channel.
+
+    Returns:
+        str - The description.
+    '''
+    global mapping
+    if mapping is None:
+        mapping = MappingIndex.load(config.MAPPING_FILE) if os.path.exists(config.MAPPING_FILE) else False
+    side, ib, i = TrimMap.location(k)
+    label = f'Side={side}, IB={ib}, I={i}'
+    if mapping:
+        tile = mapping.tile(side, ib, i)
+        if tile is not None:
+            label += f', Sector={tile[1]}, Tile={tile[2]}'
+    return label
+
+class BiasController:
+    '''
+    A session with the bias control systems in config.CONTROLLERS.
+
+    One connection per side is opened on first use and kept open until
+    close() is called, so consecutive get/set/verify operations do not pay
+    for a new connection each time.  A connection that fails is reopened and
+    the commands are sent again, up to `retries` times.
+
+    Parameters:
+        hosts: dict - The IP address of each side.  Defaults to the hosts
+                      in config.CONTROLLERS.
+        port: int - The port of every bias control system.  Defaults to
+                    the ports in config.CONTROLLERS.
+        timeout: float - Seconds to wait for a connection or a prompt.
+        retries: int - How often to reconnect after a failure.
+    '''
+    # Class used for the connections.  Can be replaced to instrument them.
+    connection_class = telnetlib.Telnet
+
+    def __init__(self, hosts: dict = None, port: int = None, timeout: float = None, retries: int = 1):
+        if hosts is None:
+            hosts = {controller['name']: controller['host'] for controller in config.CONTROLLERS}
+        self.hosts = hosts
+        if port is None:
+            self.ports = {controller['name']: controller.get('port', config.PORT) for controller in config.CONTROLLERS}
+        else:
+            self.ports = {side: port for side in hosts}
+        self.timeout = config.COMMAND_TIMEOUT if timeout is None else timeout
+        self.retries = retries
+        self.connections = {}
+        # Last trim voltages read from or written to the controllers.  Used
+        # as the reference for differential loads.
+        self.last_known_trim_voltages = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def connect(self, side: str) -> telnetlib.Telnet:
+        '''
+        Return the open connection to one side, opening it if needed.
+        '''
+        if side not in self.connections:
+            logging.debug(f'Connecting to {side} ({self.hosts[side]}:{self.ports[side]})')
+            with timing.timer('controller.connect'):
+                tn = self.connection_class(self.hosts[side], self.ports[side], self.timeout)
+            # Pipelined commands are small writes; do not hold them back
+            tn.get_socket().setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connections[side] = tn
+        return self.connections[side]
+
+    def disconnect(self, side: str) -> None:
+        '''
+        Close the connection to one side, if open.
+        '''
+        tn = self.connections.pop(side, None)
+        if tn is not None:
+            tn.close()
+
+    def close(self) -> None:
+        '''
+        Close all connections.
+        '''
+        for side in list(self.connections):
+            self.disconnect(side)
+
+    def execute(self, side: str, commands: list) -> list:
+        '''
+        Send a list of commands to one side, reconnecting on failure.
+
+        Parameters:
+            side: str - The side to send the commands to.
+            commands: list - The commands to send.
+
+        Returns:
+            list - The responses, one per command.
+
+        Raises:
+            BiasControlError - If the commands still fail after all retries.
+        '''
+        for attempt in range(self.retries + 1):
+            try:
+                return send_commands(self.connect(side), commands, timeout=self.timeout)
+            except (BiasControlError, OSError, EOFError) as e:
+                self.disconnect(side)
+                if attempt == self.retries:
+                    raise BiasControlError(f'Side={side}: {e}') from e
+                logging.warning(f'Side={side}: {e}.  Reconnecting.')
+
+    def execute_sides(self, commands: dict) -> dict:
+        '''
+        Send commands to several sides at the same time, talking to at most
+        config.MAX_PARALLEL_CONTROLLERS of them at once.
+
+        Parameters:
+            commands: dict - The commands to send, keyed by side.
+
+        Returns:
+            dict - The responses, keyed by side.
+        '''
+        commands = {side: cmds for side, cmds in commands.items() if cmds}
+        workers = max(1, min(len(commands), config.MAX_PARALLEL_CONTROLLERS))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {side: executor.submit(self.execute, side, cmds) for side, cmds in commands.items()}
+            return {side: future.result() for side, future in futures.items()}
+
+    @timing.timed('controller.get')
+    def get(self, boards: list = None) -> TrimMap:
+        ''' 
+        Get the currently loaded trim voltages.
+
+        Parameters:
+            boards: list - Optional list of (side, ib) pairs to read.  All
+                           boards are read if not given.
+
+        Returns:
+            TrimMap - The trim voltages.  Boards that were not read are 0,
+                      and board biases are not known to the controllers.
+        '''
+        if boards is None:
+            boards = TrimMap.boards()
+
+        cmd_prefix = '$GR'
+        commands = {}
+        for side, ib in boards:
+            commands.setdefault(side, []).append('%s%01d\n\r' % (cmd_prefix, ib))
+
+        if config.SIMULATE:
+            responses = {side: [''.join(['0\n\r' for i in range(TrimMap.channels(side, ib))]) + '>' for (board_side, ib) in boards if board_side == side] for side in commands}
+        else:
+            responses = self.execute_sides(commands)
+
+        trim_map = TrimMap()
+        for side, side_responses in responses.items():
+            for (_, ib), response in zip([b for b in boards if b[0] == side], side_responses):
+                voltages = response.rstrip().lstrip().replace('\r', ' ').split('\n')
+                logging.debug(f'Voltages: {voltages}')
+                trim_map.set_board(side, ib, [int(v) for v in voltages[:-1]])
+
+        if self.last_known_trim_voltages is None:
+            if len(boards) == N_BOARDS:
+                self.last_known_trim_voltages = trim_map.copy()
+        else:
+            for side, ib in boards:
+                self.last_known_trim_voltages.set_board(side, ib, trim_map.board(side, ib))
+        return trim_map
+
+    @timing.timed('controller.verify')
+    def verify(self, trim_map: TrimMap, boards: list = None) -> bool:
+        '''
+        Read back the trim voltages and compare them to the requested ones.
+
+        Parameters:
+            trim_map: TrimMap - The requested trim voltages.
+            boards: list - Optional list of (side, ib) pairs to check.  All
+                           boards are checked if not given.
+
+        Returns:
+            bool - True if all checked channels match.
+        '''
+        if boards is None:
+            boards = TrimMap.boards()
+        new_trim_voltages = self.get(boards)
+        mismatches = trim_map.diff(new_trim_voltages, boards)
+        for k in mismatches:
+            logging.warning(f'Trim voltage mismatch: {channel_label(k)}, Request={trim_map.trims[k]}, Readback={new_trim_voltages.trims[k]}')
+        return not mismatches
+
+    @timing.timed('controller.set')
+    def set(self, trim_map: TrimMap, differential: bool = False, current: TrimMap = None) -> bool:
+        '''
+        Set the trim voltages and verify them by reading them back.
+
+        In differential mode only the channels whose value differs from the
+        current state are sent, and only the boards holding those channels
+        are read back.  The current state is taken from the current argument,
+        then from the last known state, and is read from the controllers
+        otherwise.
+
+        Parameters:
+            trim_map: TrimMap - The trim voltages to set.
+            differential: bool - If True, only send channels that changed.
+            current: TrimMap - Optional trim voltages currently loaded.
+
+        Returns:
+            bool - True if the readback matches the requested trim voltages.
+        '''
+        if differential and current is None:
+            if self.last_known_trim_voltages is None:
+                logging.info('No cached trim voltages, reading them from the bias control system')
+                self.get()
+            current = self.last_known_trim_voltages
+
+        plan = self.plan(trim_map, current if differential else None)
+        if differential:
+            logging.info(f'Differential load: {", ".join(f"{len(cmds)} {side}" for side, cmds in plan["commands"].items())} channels changed')
+        return self.apply(plan)
+
+    @timing.timed('controller.ramp')
+    def ramp(self, trim_map: TrimMap, max_step: int = None) -> bool:
+        '''
+        Ramp the trim voltages to new values in bounded steps.
+
+        The steps follow trim_ramp.ramp_schedule: all boards of all sides
+        step together, each within its rate limit, and only the channels
+        that change are sent.  The ramp starts from a readback, never from
+        the cached state, so no step can be larger than planned.  The
+        boards changed by a stage are read back before the next one, and
+        the ramp stops at the first stage that fails verification.
+
+        Parameters:
+            trim_map: TrimMap - The trim voltages to ramp to.
+            max_step: int - Largest change of a channel per step.  Defaults
+                            to config.RAMP_STEP.
+
+        Returns:
+            bool - True if every stage was verified.
+        '''
+        current = self.get()
+
+        for k in trim_map.out_of_range():
+            logging.error(f'Invalid trim voltage: {channel_label(k)}, Voltage={trim_map.trims[k]}.  0 will be used instead.')
+        stages = ramp_schedule(current, trim_map.clipped(), max_step)
+        if not stages:
+            return True
+        logging.info(f'Ramping in {len(stages)} stages over {stages[-1][0]:.1f} s')
+
+        # Space the stages from when the previous one actually went out, so
+        # a slow readback never lets a board step faster than its rate
+        last_time = 0.0
+        last_sent = time.monotonic()
+        for t, stage in stages:
+            time.sleep(max(0.0, last_sent + t - last_time - time.monotonic()))
+            last_time, last_sent = t, time.monotonic()
+            if not self.apply(self.plan(stage, current)):
+                logging.error(f'Ramp stopped {t:.1f} s in: stage failed verification')
+                return False
+            current = stage
+        return True
+
+    def plan(self, trim_map: TrimMap, current: TrimMap = None) -> dict:
+        '''
+        Work out the commands that load a set of trim voltages, without
+        sending them.  Out of range trims are replaced by 0.
+
+        Parameters:
+            trim_map: TrimMap - The trim voltages to set.
+            current: TrimMap - Optional trim voltages the plan starts from.
+                               Only channels that differ from them are sent.
+                               All channels are sent if not given.
+
+        Returns:
+            dict - The requested 'trim_map', the 'commands' for each side,
+                   and the 'boards' that change.
+        '''
+        for k in trim_map.out_of_range():
+            logging.error(f'Invalid trim voltage: {channel_label(k)}, Voltage={trim_map.trims[k]}.  0 will be used instead.')
+        values = trim_map.clipped()
+
+        if current is not None:
+            changed = values.diff(current)
+        else:
+            changed = range(N_CHANNELS)
+
+        cmd_prefix = '$GS'
+        cmd_lists = {side: [] for side in SIDES}
+        changed_boards = []
+        for k in changed:
+            side, ib, i = TrimMap.location(k)
+            cmd_lists[side].append('%s%01d%02d%s\n\r' % (cmd_prefix, ib, i, str(values.trims[k])))
+            if (side, ib) not in changed_boards:
+                changed_boards.append((side, ib))
+        return {'trim_map': trim_map, 'commands': cmd_lists, 'boards': changed_boards}
+
+    def apply(self, plan: dict) -> bool:
+        '''
+        Send the commands of a plan and verify the boards they change by
+        reading them back.
+
+        Parameters:
+            plan: dict - The output of plan.
+
+        Returns:
+            bool - True if the readback matches the requested trim voltages.
+        '''
+        if config.SIMULATE:
+            logging.info('Generated command list')
+            for side, cmds in plan['commands'].items():
+                logging.info(f'{side}:')
+                logging.info(cmds)
+            return True
+
+        if not plan['boards']:
+            return True
+
+        # Program all sides at the same time
+        try:
+            self.execute_sides(plan['commands'])
+        except BiasControlError as e:
+            logging.error(f'Failed to set trim voltages: {e}')
+            # The state of the controllers is no longer known
+            self.last_known_trim_voltages = None
+            return False
+
+        # Readback the trim voltages to verify they were set correctly
+        return self.verify(plan['trim_map'], plan['boards'])
+
+
+def get_trim_voltages(boards: list = None, controller: BiasController = None) -> TrimMap:
     ''' 
     Get the currently loaded trip voltages from the bias control system.
 
     Parameters:
-        None
+        boards: list - Optional list of (side, ib) pairs to read.  All boards
+                       are read if not given.
+        controller: BiasController - The session to use.  A temporary one is
+                                     opened if not given.
 
     Returns:
-        dict - The trim voltages.
-    '''
-    north_tn = None
-    south_tn = None
-    if not config.SIMULATE:
-        north_tn = telnetlib.Telnet(config.NORTH_IP, config.PORT)
-        south_tn = telnetlib.Telnet(config.SOUTH_IP, config.PORT)
-
-    trim_voltages = {}
-    cmd_prefix = '$GR'
-    for side in ['N', 'S']:
-        trim_voltages[side] = {}
-        for ib in range(6):
-            trim_voltages[side][ib] = {}
-            # Send command to get the trim voltage
-            cmd = '%s%01d\n\r' % (cmd_prefix, ib)
-            # Read the response
-            if config.SIMULATE:
-                response = ' '.join(['0\n' for i in range(64)])
-            else:
-                if side == 'N':
-                    response = send_command(north_tn, cmd)
-                else:
-                    response = send_command(south_tn, cmd)
-            voltages = response.rstrip().lstrip().replace('\r', ' ').split('\n')
-            logging.debug(f'Voltages: {voltages}')
-            for i, voltage in enumerate(voltages[:-1]):
-                trim_voltages[side][ib][i] = int(voltage)
-    return trim_voltages
-
-
-def set_trim_voltages(trim_map: dict, ) -> bool:
-    '''
-    Set the trim voltages on the bias control system.
+        TrimMap - The trim voltages.
+    '''
+    if controller is not None:
+        return controller.get(boards)
+    with BiasController() as controller:
+        return controller.get(boards)
+
+
+def set_trim_voltages(trim_map: TrimMap, differential: bool = False, current: TrimMap = None, controller: BiasController = None) -> bool:
+    '''
+    Set the trim voltages on the bias control system.  See BiasController.set.
 
     Parameters:
-        trim_map: dict - The trim voltages to set.
+        trim_map: TrimMap - The trim voltages to set.
+        differential: bool - If True, only send channels that changed.
+        current: TrimMap - Optional trim voltages currently loaded.
+        controller: BiasController - The session to use.  A temporary one is
+                                     opened if not given.
 
     Returns:
-        None
+        bool - True if the readback matches the requested trim voltages.
     '''
+    if controller is not None:
+        return controller.set(trim_map, differential, current)
+    with BiasController() as controller:
+        return controller.set(trim_map, differential, current)
 
-    cmd_prefix = '$GS'
-    north_cmd_list = []
-    south_cmd_list = []
-    for ib in range(6):
-        for i in range(64):
-            north_val = trim_map['N'][ib][i]
-            south_val = trim_map['S'][ib][i]
-
-            if abs(north_val) > 2500:
-                logging.error(f'Invalid trim voltage: Side=N, IB={ib}, I={i}, Voltage={north_val}.  0 will be used instead.')
-                north_val = 0
-            if abs(south_val) > 2500:
-                logging.error(f'Invalid trim voltage: Side=S, IB={ib}, I={i}, Voltage={south_val}.  0 will be used instead.')
-                south_val = 0
-            
-            north_cmd_list.append('%s%01d%02d%s\n\r' % (cmd_prefix, ib, i, str(north_val)))
-            south_cmd_list.append('%s%01d%02d%s\n\r' % (cmd_prefix, ib, i, str(south_val)))
-    
-    if config.SIMULATE:
-        logging.info('Generated command list')
-        logging.info('North:')
-        logging.info(north_cmd_list)
-        logging.info('South:')
-        logging.info(south_cmd_list)
-        return True
-    
-    with telnetlib.Telnet(config.NORTH_IP, config.PORT) as north_tn:
-        for cmd in north_cmd_list:
-            send_command(north_tn, cmd)
-    with telnetlib.Telnet(config.SOUTH_IP, config.PORT) as south_tn:
-        for cmd in south_cmd_list:
-            send_command(south_tn, cmd)
-
-    # Readback the trim voltages to verify they were set correctly
-    new_trim_voltages = get_trim_voltages()
-    match = True
-    for side in ['N', 'S']:
-        for ib in range(6):
-            for i in range(64):
-                if trim_map[side][ib][i] != new_trim_voltages[side][ib][i]:
-                    match = False
-                    logging.warning(f'Trim voltage mismatch: Side={side}, IB={ib}, I={i}, Request={trim_map[side][ib][i]}, Readback={new_trim_voltages[side][ib][i]}')
-    return match
+def read_loaded_biases() -> array.array:
+    '''
+    Read the board voltages of the bias map in the bias control folder.
+
+    Returns:
+        array.array - The board voltages, or None if there is no bias map.
+    '''
+    bias_map = os.path.join(config.BIAS_CONTROL_FOLDER, INSTALLED_NAME)
+    if not os.path.exists(bias_map):
+        logging.warning(f'No bias map at {bias_map}, board voltages are not known')
+        return None
+    return array.array('d', read_bias_map(bias_map))
+
+def get_loaded_voltages(controller: BiasController) -> TrimMap:
+    '''
+    Get the loaded trim voltages together with the board voltages of the
+    bias map in the bias control folder.
 
+    Parameters:
+        controller: BiasController - The session to use.
+
+    Returns:
+        TrimMap - The trim and board voltages.
+    '''
+    trim_map = controller.get()
+    biases = read_loaded_biases()
+    if biases is not None:
+        trim_map.biases = biases
+    return trim_map
+
+def set_result(trim_map: TrimMap, verified: bool, controller: BiasController) -> TrimMap:
+    '''
+    Return the trim and board voltages loaded after a set, to record in the
+    history.  These are the requested ones if the readback matched them, and
+    are read again otherwise.
+
+    Parameters:
+        trim_map: TrimMap - The requested trim and board voltages.
+        verified: bool - Whether the readback matched the request.
+        controller: BiasController - The session used for the set.
+
+    Returns:
+        TrimMap - The loaded trim and board voltages.
+    '''
+    if verified:
+        return trim_map.clipped()
+    return get_loaded_voltages(controller)
+
+def backup(controller: BiasController, timestamp: str = None) -> TrimMap:
+    '''
+    Back up the bias map and the loaded trim voltages, as text and as a
+    snapshot.
+
+    Parameters:
+        controller: BiasController - The session to use.
+        timestamp: str - Timestamp in the file names.  Defaults to
+                         config.TIMESTAMP.
+
+    Returns:
+        TrimMap - The backed up trim and board voltages.
+    '''
+    if timestamp is None:
+        timestamp = config.TIMESTAMP
+    backup_bias_map(os.path.join(config.BIAS_MAPS_FOLDER, f'sEPD_HVSet_backup_{timestamp}.txt'))
+    original_trim_voltages = get_loaded_voltages(controller)
+    write_trim_voltage_file(os.path.join(config.BIAS_MAPS_FOLDER, f'trim_voltages_{timestamp}.txt'), original_trim_voltages)
+    record_snapshot(original_trim_voltages, 'backup', source=os.path.join(config.BIAS_MAPS_FOLDER, f'trim_voltages_{timestamp}.txt'))
+    write_snapshot(os.path.join(config.BIAS_MAPS_FOLDER, f'trim_voltages_{timestamp}{SNAPSHOT_EXTENSION}'), original_trim_voltages)
+    timing.write_summary(os.path.join(config.BIAS_MAPS_FOLDER, f'trim_voltages_{timestamp}_timing.json'))
+    logging.info(f'Backup complete: timestamp {timestamp}')
+    return original_trim_voltages
+
+def apply_trim_voltages(trim_voltages: TrimMap, differential: bool = False, controller: BiasController = None, ramp: bool = False, current: TrimMap = None) -> bool:
+    '''
+    Set the trim voltages and load a bias map with the board voltages.
+
+    Parameters:
+        trim_voltages: TrimMap - The trim and board voltages.
+        differential: bool - If True, only send channels that changed.
+        controller: BiasController - The session to use.
+        ramp: bool - If True, ramp the trim voltages in steps of at most
+                     config.RAMP_STEP (see BiasController.ramp).
+        current: TrimMap - Optional trim voltages currently loaded, for
+                           differential sets.
+
+    Returns:
+        bool - True if the readback matches the requested trim voltages.
+    '''
+    if ramp:
+        verified = controller.ramp(trim_voltages)
+    else:
+        verified = set_trim_voltages(trim_voltages, differential=differential, current=current, controller=controller)
+    bias_map = generate_bias_map(trim_voltages.biases)
+    load_bias_map(bias_map)
+    if controller is None:
+        with BiasController() as controller:
+            loaded = set_result(trim_voltages, verified, controller)
+    else:
+        loaded = set_result(trim_voltages, verified, controller)
+    record_snapshot(loaded, 'set', details={'verified': verified, 'differential': differential, 'ramp': ramp, 'bias_map': bias_map})
+    return verified
+
+def import_history(folder: str = None) -> int:
+    '''
+    Add the backups written before the history existed to it.  Every
+    trim_voltages_<timestamp> file (the text file if there is one, the
+    snapshot otherwise) is recorded at its timestamp, with the board voltages
+    of the bias map backed up with it.  Files already in the history are
+    skipped.
+
+    Parameters:
+        folder: str - Where the backups are.  Defaults to
+                      config.BIAS_MAPS_FOLDER.
+
+    Returns:
+        int - The number of snapshots added.
+    '''
+    if folder is None:
+        folder = config.BIAS_MAPS_FOLDER
+    backups = {}
+    for file_name in sorted(glob.glob(os.path.join(folder, 'trim_voltages_*'))):
+        match = re.fullmatch(r'trim_voltages_(\d{14})(\.txt|' + re.escape(SNAPSHOT_EXTENSION) + ')', os.path.basename(file_name))
+        # text files sort after snapshots and replace them, since backup
+        # records the text file as the source
+        if match:
+            backups[match.group(1)] = file_name
+
+    added = 0
+    with TrimHistory() as history:
+        for timestamp, file_name in sorted(backups.items()):
+            if history.has_source(file_name):
+                continue
+            try:
+                trim_map = read_trim_voltage_file(file_name)
+            except SystemExit:
+                logging.error(f'Skipping {file_name}')
+                continue
+            bias_map = os.path.join(folder, f'sEPD_HVSet_backup_{timestamp}.txt')
+            if os.path.exists(bias_map):
+                trim_map.biases = array.array('d', read_bias_map(bias_map))
+            history.record(trim_map, 'backup', parse_timestamp(timestamp), file_name)
+            added += 1
+    logging.info(f'Added {added} of {len(backups)} backups to {config.HISTORY_DB}')
+    return added
+
+def run_pattern_sequence(file_names: list, n_events: int, controller: BiasController) -> dict:
+    '''
+    Load a set of trim voltage files one after the other over one session,
+    taking a run with each.
+
+    The files are reordered to change as few channels as possible between
+    consecutive patterns, and the commands of every step are worked out
+    before the first is sent, so each step only sends the channels that
+    differ from the previous pattern.  A bias map is loaded only when the
+    board voltages change.  The original trim voltages and bias map are
+    restored however the sequence ends.
+
+    Parameters:
+        file_names: list - The trim voltage files, e.g. from
+                           MakeTwelvePatternFiles.py.
+        n_events: int - The number of events to record with each pattern.
+        controller: BiasController - The session to use.
+
+    Returns:
+        dict - Information about each pattern, by file name, in the order
+               they were loaded.
+    '''
+    patterns = {file_name: read_trim_voltage_file(file_name) for file_name in file_names}
+    # the plans start from a readback, not from what the session last set
+    start = get_loaded_voltages(controller)
+    order = order_patterns(patterns, start)
+    logging.info(f'Pattern order: {", ".join(os.path.basename(file_name) for file_name in order)}')
+
+    # Work out every step before touching the controllers
+    plans = []
+    loaded = start
+    for file_name in order:
+        plans.append(controller.plan(patterns[file_name], loaded))
+        loaded = patterns[file_name].clipped()
+    n_commands = sum(len(cmds) for plan in plans for cmds in plan['commands'].values())
+    logging.info(f'{n_commands} channel changes for {len(order)} patterns, instead of {N_CHANNELS * len(order)} with full loads')
+    bias_maps = render_bias_maps([patterns[file_name].biases for file_name in order])
+
+    backup_file_name = os.path.join(config.BIAS_MAPS_FOLDER, f'sEPD_HVSet_backup_{config.TIMESTAMP}.txt')
+    backup_bias_map(backup_file_name)
+
+    sequence_info = {}
+    loaded = start
+    biases = start.biases
+    try:
+        for file_name, plan, bias_map in zip(order, plans, bias_maps):
+            logging.info(f'Loading {file_name}')
+            if loaded is None:
+                # the plan assumed the previous step worked, send every channel
+                plan = controller.plan(patterns[file_name])
+            verified = controller.apply(plan)
+            if patterns[file_name].biases != biases:
+                load_bias_map(bias_map)
+                biases = patterns[file_name].biases
+            # a failed step leaves the controllers in an unknown state
+            loaded = patterns[file_name].clipped() if verified else None
+            sequence_info[file_name] = {
+                'verified': verified,
+                'changed_channels': sum(len(cmds) for cmds in plan['commands'].values()),
+                'bias_map': bias_map,
+                'run_info': record_events(n_events, settle=config.BIAS_SETTLE_TIME),
+            }
+            record_snapshot(set_result(patterns[file_name], verified, controller), 'pattern', source=file_name, details=sequence_info[file_name])
+    finally:
+        logging.info('Restoring the original trim voltages and bias map')
+        verified = controller.set(start, differential=True, current=loaded)
+        install_bias_map(backup_file_name)
+        record_snapshot(set_result(start, verified, controller), 'restore', source=backup_file_name, details={'verified': verified})
+
+    with open(f'run_info/pattern_sequence_{config.TIMESTAMP}.json', 'w') as f:
+        json.dump(sequence_info, f, indent=4)
+    return sequence_info
+
+def restored_voltages(timestamp: str) -> TrimMap:
+    '''
+    Return the trim and board voltages recorded in the history at or
+    before a timestamp in the format of config.TIMESTAMP.
+    '''
+    with TrimHistory() as history:
+        try:
+            return history.state_at(parse_timestamp(timestamp))
+        except KeyError as e:
+            logging.critical(f'Error: {e.args[0]}')
+            sys.exit(1)
+
+def run_client(args, client: DaemonClient) -> None:
+    '''
+    Carry out --backup, --set_base, --set, --restore and --get through the
+    daemon.
+    '''
+    if args.backup:
+        logging.info(f'Backup complete: timestamp {client.backup()}')
+    if args.set_base:
+        if args.set_base < 0 or args.set_base > 60:
+            logging.error('Invalid base voltage.  Must be between 0 and 60')
+            sys.exit(1)
+        trim_voltages = TrimMap()
+        trim_voltages.set_biases(args.set_base)
+        client.set(trim_voltages, differential=args.diff, ramp=args.ramp)
+    elif args.set:
+        client.set(read_trim_voltage_file(args.set), differential=args.diff, ramp=args.ramp)
+    elif args.restore:
+        client.set(restored_voltages(args.restore), differential=args.diff, ramp=args.ramp)
+    elif args.get:
+        trim_voltages = client.get()
+        write_trim_voltage_file(args.get, trim_voltages)
+        record_snapshot(trim_voltages, 'get', source=args.get)
 
 def main(argv):
     parser = argparse.ArgumentParser(description='sEPD Bias Scan')
@@ -351,66 +1020,113 @@ def main(argv):
     parser.add_argument('--set_base', metavar='voltage', type=float, help='Set the base voltage for the bias scan')
     parser.add_argument('--backup', action='store_true', help='Backup the current bias map')
     parser.add_argument('--set', metavar='file_name', type=str, help='Set the trim voltages to the values in the specified trim voltage file')
-    parser.add_argument('--get', metavar='output_file_name', type=str, help='Stores the currently loaded trim voltages in the specified file')
+    parser.add_argument('--restore', metavar='timestamp', type=str, help='Set the trim and board voltages recorded in the history at the given time (YYYYmmddHHMMSS)')
+    parser.add_argument('--import_history', action='store_true', help='Add the trim voltage backups in the bias maps folder to the history')
+    parser.add_argument('--diff', action='store_true', help='With --set, --set_base or --restore, only send the trim voltages that differ from the loaded ones')
+    parser.add_argument('--ramp', action='store_true', help='With --set, --set_base or --restore, ramp the trim voltages in bounded steps (see config.RAMP_STEP and config.RAMP_RATE)')
+    parser.add_argument('--scan', metavar='voltage', type=float, nargs='+', help='Run a bias scan over the given voltages')
+    parser.add_argument('--events', metavar='n_events', type=int, default=1000, help='Number of events to record at each scan voltage')
+    parser.add_argument('--sequence', metavar='file_name', type=str, nargs='+', help='Load each trim voltage file in turn, in the order with the fewest channel changes, and take a run of --events events with each')
+    parser.add_argument('--resume', metavar='journal', type=str, nargs='?', const='latest', help='Resume an unfinished bias scan from its journal (default: the most recent unfinished one)')
+    parser.add_argument('--get', metavar='output_file_name', type=str, help='Stores the currently loaded trim voltages in the specified file (binary snapshot if it ends in .snap)')
+    parser.add_argument('--convert', metavar=('input_file_name', 'output_file_name'), type=str, nargs=2, help='Convert a trim voltage file between the text and binary snapshot formats')
+
+    parser.add_argument('--no_daemon', action='store_true', help='Talk to the bias control systems directly even if bias_daemon.py is running')
+    parser.add_argument('--timing', action='store_true', help='Record the time taken by every controller, file and DAQ operation and save a summary with scans and backups')
 
     # Add logging options
     parser.add_argument('--log', metavar='log_level', type=str, default='INFO', help='Set the logging level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'])
 
     args = parser.parse_args()
     logging.basicConfig(level=getattr(logging, args.log))
+    if args.timing:
+        timing.enabled = True
 
     # make all needed folders
     os.makedirs(config.BIAS_MAPS_FOLDER, exist_ok=True)
     os.makedirs('run_info', exist_ok=True)
 
-    if args.backup:
-        # backup bias and trim
-        subprocess.run(['cp', os.path.join(config.BIAS_CONTROL_FOLDER, 'sEPD_HVSet.txt'), os.path.join(config.BIAS_MAPS_FOLDER, f'sEPD_HVSet_backup_{config.TIMESTAMP}.txt')])
-        original_trim_voltages = get_trim_voltages()
-        write_trim_voltage_file(os.path.join(config.BIAS_MAPS_FOLDER, f'trim_voltages_{config.TIMESTAMP}.txt'), original_trim_voltages)
-        logging.info(f'Backup complete: timestamp {config.TIMESTAMP}')
+    # --backup, --set_base, --set, --restore and --get go through the daemon if one is
+    # running, since it already holds the connections and the state
+    local_only = args.scan or args.sequence or args.resume or args.import_history or args.convert or args.generate_demo
+    client = DaemonClient.connect()
+    if client is not None:
+        with client:
+            if not (args.no_daemon or local_only):
+                run_client(args, client)
+                return
+        # Writing the trims behind the daemon's back, directly or with a
+        # pattern sequence, would leave its state wrong
+        if args.set_base or args.set or args.restore or args.sequence:
+            logging.error(f'bias_daemon.py is listening on {config.DAEMON_SOCKET}.  Set the trim voltages through it, or stop it first.')
+            sys.exit(1)
+
+    # One session with the bias control systems for all operations
+    with BiasController() as controller:
+        if args.backup:
+            # backup bias and trim
+            backup(controller)
 
 
-    # if args.scan:
-    #     # Save current trim voltages
-    #     original_trim_voltages = get_trim_voltages()
-    #     write_trim_voltage_file(os.path.join(config.BIAS_MAPS_FOLDER, f'trim_voltages_{config.TIMESTAMP}.txt'), original_trim_voltages)
+        # if args.scan:
+        #     # Save current trim voltages
+        #     original_trim_voltages = get_trim_voltages()
+        #     write_trim_voltage_file(os.path.join(config.BIAS_MAPS_FOLDER, f'trim_voltages_{config.TIMESTAMP}.txt'), original_trim_voltages)
         
-    #     # Generate 0 trim map file
-    #     generate_empty_trim_file(os.path.join(config.BIAS_MAPS_FOLDER, 'trim_zero.txt'))
-    #     set_trim_voltages(read_trim_voltage_file(os.path.join(config.BIAS_MAPS_FOLDER, 'trim_zero.txt')), )
-    #     run_scans(args.scan)
+        #     # Generate 0 trim map file
+        #     generate_empty_trim_file(os.path.join(config.BIAS_MAPS_FOLDER, 'trim_zero.txt'))
+        #     set_trim_voltages(read_trim_voltage_file(os.path.join(config.BIAS_MAPS_FOLDER, 'trim_zero.txt')), )
+        #     run_scans(args.scan)
 
-    #     # Restore original trim voltages
-    #     set_trim_voltages(original_trim_voltages)
+        #     # Restore original trim voltages
+        #     set_trim_voltages(original_trim_voltages)
 
-    if args.generate_demo:
-        logging.info('Generating demo trim voltage file')
-        generate_empty_trim_file(os.path.join(config.BIAS_MAPS_FOLDER, 'trim_voltages.txt'))
+        if args.resume:
+            journal = find_unfinished_journal('run_info') if args.resume == 'latest' else args.resume
+            if journal is None:
+                logging.error('No unfinished scan to resume')
+                sys.exit(1)
+            run_scans(resume=journal, controller=controller)
 
-    elif args.set_base:
-        # Set a bias voltage
-        if args.set_base < 0 or args.set_base > 60:
-            logging.error('Invalid base voltage.  Must be between 0 and 60')
-            sys.exit(1)
-        base_voltage = args.set_base
+        elif args.scan:
+            run_scans(args.scan, args.events, controller=controller)
 
-        # Set the trim voltages to 0
-        generate_empty_trim_file(base_voltage, os.path.join(config.BIAS_MAPS_FOLDER, 'trim_zero.txt'))
-        trim_voltages, board_voltages = read_trim_voltage_file(os.path.join(config.BIAS_MAPS_FOLDER, 'trim_zero.txt'))
-        set_trim_voltages(trim_voltages)
-        bias_map = generate_bias_map(board_voltages)
-        load_bias_map(bias_map)
+        elif args.sequence:
+            run_pattern_sequence(args.sequence, args.events, controller)
 
-    elif args.set:
-        trim_voltages, board_voltages = read_trim_voltage_file(args.set)
-        set_trim_voltages(trim_voltages)
-        bias_map = generate_bias_map(board_voltages)
-        load_bias_map(bias_map)
+        elif args.import_history:
+            import_history()
 
-    elif args.get:
-        trim_voltages = get_trim_voltages()
-        write_trim_voltage_file(args.get, trim_voltages)
+        elif args.convert:
+            write_trim_voltage_file(args.convert[1], read_trim_voltage_file(args.convert[0]))
+
+        elif args.generate_demo:
+            logging.info('Generating demo trim voltage file')
+            generate_empty_trim_file(os.path.join(config.BIAS_MAPS_FOLDER, 'trim_voltages.txt'))
+
+        elif args.set_base:
+            # Set a bias voltage
+            if args.set_base < 0 or args.set_base > 60:
+                logging.error('Invalid base voltage.  Must be between 0 and 60')
+                sys.exit(1)
+            base_voltage = args.set_base
+
+            # Set the trim voltages to 0
+            generate_empty_trim_file(base_voltage, os.path.join(config.BIAS_MAPS_FOLDER, 'trim_zero.txt'))
+            trim_voltages = read_trim_voltage_file(os.path.join(config.BIAS_MAPS_FOLDER, 'trim_zero.txt'))
+            apply_trim_voltages(trim_voltages, differential=args.diff, controller=controller, ramp=args.ramp)
+
+        elif args.set:
+            trim_voltages = read_trim_voltage_file(args.set)
+            apply_trim_voltages(trim_voltages, differential=args.diff, controller=controller, ramp=args.ramp)
+
+        elif args.restore:
+            apply_trim_voltages(restored_voltages(args.restore), differential=args.diff, controller=controller, ramp=args.ramp)
+
+        elif args.get:
+            trim_voltages = get_loaded_voltages(controller)
+            write_trim_voltage_file(args.get, trim_voltages)
+            record_snapshot(trim_voltages, 'get', source=args.get)
 
 if __name__ == '__main__':
     main(sys.argv)
@@ -1,23 +1,216 @@
+#! /usr/bin/python3
+
+import argparse
+import json
+import logging
+import os
+import sys
+
 import ROOT
 
+import config
+from run_cache import RunCache
+from trim_map import N_CHANNELS
+
+# Per-channel results of summarize_run.  Every channel has one amplitude per
+# event, so 'counts' includes the pedestal; the mip_ columns only use
+# amplitudes above config.MIP_THRESHOLD.
+SUMMARY_COLUMNS = ('counts', 'mean', 'std', 'peak', 'mip_counts', 'mip_std')
+# Change whenever the reduction changes, so cached summaries are redone
+REDUCTION_VERSION = '2'
+
+def reduction_version() -> str:
+    '''
+    Return the version of the reduction, including the settings it uses.
+    '''
+    return f'{REDUCTION_VERSION}|{config.WAVEFORM_TREE}|{config.AMPLITUDE_BRANCH}|{config.AMPLITUDE_BINS}|{config.AMPLITUDE_RANGE}|{config.MIP_THRESHOLD}'
+
+def root_file_name(run_info: dict) -> str:
+    '''
+    Return the ROOT file holding the reduced waveforms of a run.
+
+    The DAQ writes a PRDF file.  Converting it with WD409 gives a TTree in a
+    ROOT file of the same name, which is used unless run_info names one.
+
+    Parameters:
+        run_info: dict - The run information from run_scans.
+
+    Returns:
+        str - The ROOT file name.
+    '''
+    if 'root_file' in run_info:
+        return run_info['root_file']
+    return os.path.splitext(run_info['file_path'])[0] + '.root'
+
 def load_run(run_info: dict) -> ROOT.RDataFrame:
     '''
-    Load the run information from the dictionary and return a pandas DataFrame object
+    Open the waveform tree of a run.
+
+    A 'channel' column is defined alongside config.AMPLITUDE_BRANCH, holding
+    the flat channel index (see TrimMap.index) of every amplitude.
+
+    Parameters:
+        run_info: dict - The run information from run_scans.
+
+    Returns:
+        ROOT.RDataFrame - The data frame.
+    '''
+    file_name = root_file_name(run_info)
+    if not os.path.exists(file_name):
+        raise FileNotFoundError(f'{file_name} not found.  Convert {run_info.get("file_path")} with WD409 first.')
+    df = ROOT.RDataFrame(config.WAVEFORM_TREE, file_name)
+    return df.Define('channel', f'''
+        ROOT::VecOps::RVec<int> channel({config.AMPLITUDE_BRANCH}.size());
+        std::iota(channel.begin(), channel.end(), 0);
+        return channel;''')
+
+def book_run(df: ROOT.RDataFrame, name: str) -> dict:
+    '''
+    Book the reduction of a run without running it.
+
+    Every channel's amplitude spectrum is one row of a single channel versus
+    amplitude histogram, so all of them are filled in one event loop.
 
     Parameters:
-        run_info (dict): Dictionary containing the run information
+        df: ROOT.RDataFrame - The data frame from load_run.
+        name: str - Name of the histogram.
+
+    Returns:
+        dict - The booked results, for RunGraphs and summarize_run.
+    '''
+    model = ROOT.RDF.TH2DModel(name, f'{name};channel;amplitude',
+                               N_CHANNELS, -0.5, N_CHANNELS - 0.5,
+                               config.AMPLITUDE_BINS, *config.AMPLITUDE_RANGE)
+    return {
+        'events': df.Count(),
+        'spectra': df.Histo2D(model, 'channel', config.AMPLITUDE_BRANCH),
+    }
+
+def summarize_run(booked: dict) -> dict:
+    '''
+    Collect the results of a booked reduction.
 
+    Parameters:
+        booked: dict - The results from book_run.
 
     Returns:
-        pd.DataFrame: DataFrame object
+        dict - The number of events, the channel versus amplitude histogram,
+               and the counts, mean and standard deviation of every channel,
+               with the position of its MIP peak and the counts and standard
+               deviation above config.MIP_THRESHOLD.
+    '''
+    spectra = booked['spectra'].GetValue()
+    summary = {'events': booked['events'].GetValue(), 'spectra': spectra}
+    summary.update({column: [] for column in SUMMARY_COLUMNS})
+    for k in range(N_CHANNELS):
+        spectrum = spectra.ProjectionY(f'{spectra.GetName()}_{k}', k + 1, k + 1)
+        summary['counts'].append(spectrum.Integral())
+        summary['mean'].append(spectrum.GetMean())
+        summary['std'].append(spectrum.GetStdDev())
+        # the MIP peak is the highest bin above the pedestal
+        spectrum.GetXaxis().SetRangeUser(config.MIP_THRESHOLD, config.AMPLITUDE_RANGE[1])
+        summary['peak'].append(spectrum.GetXaxis().GetBinCenter(spectrum.GetMaximumBin()))
+        summary['mip_counts'].append(spectrum.Integral())
+        summary['mip_std'].append(spectrum.GetStdDev())
+        spectrum.Delete()
+    return summary
+
+def scan_points(scan_info: dict) -> dict:
+    '''
+    Return the run information of every point of a bias scan (scan_info
+    from run_scans), by voltage, or of a pattern sequence
+    (pattern_sequence from run_pattern_sequence), by pattern file.
+    '''
+    points = {}
+    for key, info in scan_info.items():
+        if 'run_info' in info:
+            points[key] = info['run_info']
+        else:
+            points[float(key)] = info
+    return points
+
+def point_name(point) -> str:
     '''
+    Return a short name for a scan voltage or a pattern file.
+    '''
+    if isinstance(point, float):
+        return f'{point:.2f}V'
+    return os.path.splitext(os.path.basename(point))[0]
+
+def reduce_scan(scan_info: dict, threads: int = None, cache: RunCache = None) -> dict:
+    '''
+    Reduce every point of a bias scan or a pattern sequence.
+
+    Points already in the cache are not read again.  The event loops of the
+    rest are run together by RunGraphs, each one spread over the implicit
+    multithreading pool, and their summaries are added to the cache.
+
+    Parameters:
+        scan_info: dict - The scan information from run_scans, by voltage,
+                          or from run_pattern_sequence, by pattern file.
+        threads: int - Size of the thread pool.  Defaults to
+                       config.REDUCTION_THREADS; 0 uses every core.
+        cache: RunCache - Optional cache of summaries.
+
+    Returns:
+        dict - The summarize_run result of every point, by voltage or
+               pattern file.  Points taken from the cache have no 'spectra'.
+    '''
+    if threads is None:
+        threads = config.REDUCTION_THREADS
+
+    reduced = {}
+    booked = {}
+    for point, run_info in scan_points(scan_info).items():
+        if 'file_path' not in run_info:
+            logging.warning(f'No data file recorded for {point_name(point)}, skipping')
+            continue
+        if cache is not None and os.path.exists(root_file_name(run_info)):
+            summary = cache.get(root_file_name(run_info))
+            if summary is not None:
+                reduced[point] = summary
+                continue
+        if not ROOT.IsImplicitMTEnabled():
+            ROOT.EnableImplicitMT(threads)
+        booked[point] = (run_info, book_run(load_run(run_info), f'spectra_{point_name(point)}'))
+    logging.info(f'{len(reduced)} scan points cached')
+
+    handles = [result for _, results in booked.values() for result in results.values()]
+    if handles:
+        logging.info(f'Reducing {len(booked)} scan points on {ROOT.GetThreadPoolSize()} threads')
+        ROOT.RDF.RunGraphs(handles)
+    for point, (run_info, results) in booked.items():
+        reduced[point] = summarize_run(results)
+        if cache is not None:
+            cache.put(root_file_name(run_info), reduced[point])
+    return {point: reduced[point] for point in sorted(reduced)}
 
-    # How do I want to do this?  WD409 is the simple option, it spits out a ttree.  I could
-    # then read that with an RDataFrame, keeping things in the root ecosystem.  Or I could do it
-    # the right way and use the production chain to process the waveforms.  WD409 sounds easy..... 
+def main(argv):
+    parser = argparse.ArgumentParser(description='sEPD gain matching')
+    parser.add_argument('scan_info', metavar='scan_info', type=str, help='Scan information JSON file written by run_scans or run_pattern_sequence')
+    parser.add_argument('--output', metavar='base_name', type=str, help='Base name of the reduced .root and .json files (default: the scan information file name with _reduced appended)')
+    parser.add_argument('--threads', metavar='n', type=int, help='Number of threads (0 uses every core)')
+    parser.add_argument('--no_cache', action='store_true', help='Reduce every point again instead of using cached summaries')
+    parser.add_argument('--hash', action='store_true', help='Identify cached runs by the contents of their files rather than their size and modification time')
+    parser.add_argument('--log', metavar='log_level', type=str, default='INFO', help='Set the logging level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'])
+    args = parser.parse_args(argv[1:])
+    logging.basicConfig(level=getattr(logging, args.log))
 
-    # Copy the files somewhere useful
-    
+    with open(args.scan_info, 'r') as f:
+        scan_info = json.load(f)
+    cache = None if args.no_cache else RunCache(SUMMARY_COLUMNS, reduction_version(), content_hash=args.hash)
+    reduced = reduce_scan(scan_info, args.threads, cache)
 
+    base_name = args.output or f'{os.path.splitext(args.scan_info)[0]}_reduced'
+    output = ROOT.TFile(f'{base_name}.root', 'RECREATE')
+    for summary in reduced.values():
+        if 'spectra' in summary:
+            summary['spectra'].Write()
+    output.Close()
+    with open(f'{base_name}.json', 'w') as f:
+        json.dump({voltage: {key: value for key, value in summary.items() if key != 'spectra'}
+                   for voltage, summary in reduced.items()}, f, indent=4)
+    logging.info(f'Wrote {base_name}.root and {base_name}.json')
 
-    #
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,109 @@
+import glob
+import json
+import logging
+import os
+import time
+
+import timing
+
+class ScanJournal:
+    '''
+    An append-only record of a bias scan.  Every record is one JSON line,
+    flushed to disk before append returns, so a scan that dies part way
+    through leaves a journal of every point it finished.
+
+    The first record has type 'start' and holds the scan parameters, each
+    finished point adds a 'step' record, and a finished scan ends with an
+    'end' record.
+
+    Parameters:
+        file_name: str - The journal file.  Created if it does not exist.
+    '''
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.records = read_journal(file_name) if os.path.exists(file_name) else []
+
+    def append(self, record: dict) -> None:
+        '''
+        Add a record to the journal and flush it to disk.
+
+        Parameters:
+            record: dict - The record.  A 'time' field is added.
+
+        Returns:
+            None
+        '''
+        record = dict(record, time=time.time())
+        with timing.timer('file.journal_append'), open(self.file_name, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.records.append(record)
+
+    @property
+    def start(self) -> dict:
+        '''
+        The start record, or None if the scan was never started.
+        '''
+        for record in self.records:
+            if record['type'] == 'start':
+                return record
+        return None
+
+    @property
+    def steps(self) -> list:
+        '''
+        The records of the finished points, in order.
+        '''
+        return [record for record in self.records if record['type'] == 'step']
+
+    @property
+    def finished(self) -> bool:
+        '''
+        True if the scan ran to completion.
+        '''
+        return any(record['type'] == 'end' for record in self.records)
+
+    def completed_voltages(self) -> list:
+        '''
+        Return the voltages of the finished points, in order.
+        '''
+        return [step['voltage'] for step in self.steps]
+
+def read_journal(file_name: str) -> list:
+    '''
+    Read the records of a journal.  A partially written last line, left by
+    a crash during a write, is ignored.
+
+    Parameters:
+        file_name: str - The journal file.
+
+    Returns:
+        list - The records.
+    '''
+    records = []
+    with open(file_name, 'r') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                logging.warning(f'{file_name}: ignoring incomplete record on line {line_number}')
+    return records
+
+def find_unfinished_journal(folder: str) -> str:
+    '''
+    Return the most recent journal in the folder whose scan did not finish,
+    or None.
+
+    Parameters:
+        folder: str - The folder holding the journals.
+
+    Returns:
+        str - The journal file name.
+    '''
+    for file_name in sorted(glob.glob(os.path.join(folder, 'scan_journal_*.jsonl')), reverse=True):
+        if not ScanJournal(file_name).finished:
+            return file_name
+    return None
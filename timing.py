@@ -0,0 +1,144 @@
+import bisect
+import contextlib
+import functools
+import json
+import threading
+import time
+
+import config
+
+# Set to True to record timings.  When False, timer() and timed() cost a
+# flag check per call.
+enabled = config.TIMING
+
+# Upper edges of the histogram bins in seconds, 10 us to about 80 s in
+# factors of 2.  Longer durations go into an overflow bin.
+BIN_EDGES = tuple(1e-5 * 2 ** n for n in range(24))
+
+class Stat:
+    '''
+    Count, total, extremes and histogram of the durations of one operation.
+    '''
+    __slots__ = ('count', 'total', 'min', 'max', 'bins')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self.bins = [0] * (len(BIN_EDGES) + 1)
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        self.bins[bisect.bisect_left(BIN_EDGES, seconds)] += 1
+
+    def quantile(self, q: float) -> float:
+        '''
+        Return the upper edge of the bin holding the q quantile.
+        '''
+        rank = q * self.count
+        seen = 0
+        for n, count in enumerate(self.bins):
+            seen += count
+            if seen >= rank and count:
+                return BIN_EDGES[n] if n < len(BIN_EDGES) else self.max
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'histogram': [[BIN_EDGES[n] if n < len(BIN_EDGES) else None, count] for n, count in enumerate(self.bins) if count],
+        }
+
+stats = {}
+lock = threading.Lock()
+
+def record(name: str, seconds: float) -> None:
+    '''
+    Add the duration of one operation.
+    '''
+    with lock:
+        stat = stats.get(name)
+        if stat is None:
+            stat = stats[name] = Stat()
+        stat.add(seconds)
+
+class Timer:
+    '''
+    Context manager recording the time spent in its block.
+    '''
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        record(self.name, time.perf_counter() - self.start)
+
+NULL_TIMER = contextlib.nullcontext()
+
+def timer(name: str):
+    '''
+    Return a context manager timing its block as the operation name, or one
+    doing nothing if timing is disabled.
+    '''
+    return Timer(name) if enabled else NULL_TIMER
+
+def timed(name: str):
+    '''
+    Decorator timing every call of a function as the operation name.
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+def summary() -> dict:
+    '''
+    Return the statistics of every operation, by name.
+    '''
+    with lock:
+        return {name: stats[name].summary() for name in sorted(stats)}
+
+def reset() -> None:
+    with lock:
+        stats.clear()
+
+def write_summary(file_name: str) -> str:
+    '''
+    Write the summary to a JSON file if timing is enabled and anything was
+    recorded.
+
+    Parameters:
+        file_name: str - The file.
+
+    Returns:
+        str - The file name, or None if nothing was written.
+    '''
+    if not enabled or not stats:
+        return None
+    with open(file_name, 'w') as f:
+        json.dump(summary(), f, indent=4)
+    return file_name
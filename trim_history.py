@@ -0,0 +1,304 @@
+#! /usr/bin/python3
+
+import argparse
+import datetime
+import json
+import logging
+import sqlite3
+import sys
+import time
+
+import config
+import timing
+from trim_map import TrimMap, BOARD_LIST, N_CHANNELS
+
+TIMESTAMP_FORMAT = '%Y%m%d%H%M%S'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    kind TEXT NOT NULL,
+    source TEXT,
+    details TEXT
+);
+CREATE INDEX IF NOT EXISTS snapshots_time ON snapshots (time);
+CREATE INDEX IF NOT EXISTS snapshots_source ON snapshots (source);
+CREATE TABLE IF NOT EXISTS trims (
+    snapshot INTEGER NOT NULL REFERENCES snapshots (id),
+    side TEXT NOT NULL,
+    ib INTEGER NOT NULL,
+    channel INTEGER NOT NULL,
+    value INTEGER NOT NULL,
+    PRIMARY KEY (snapshot, side, ib, channel)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS trims_channel ON trims (side, ib, channel, snapshot);
+CREATE TABLE IF NOT EXISTS biases (
+    snapshot INTEGER NOT NULL REFERENCES snapshots (id),
+    side TEXT NOT NULL,
+    ib INTEGER NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (snapshot, side, ib)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS biases_board ON biases (side, ib, snapshot);
+'''
+
+def parse_timestamp(timestamp: str) -> float:
+    '''
+    Return the seconds since the epoch of a timestamp in the format of
+    config.TIMESTAMP.
+    '''
+    return datetime.datetime.strptime(timestamp, TIMESTAMP_FORMAT).timestamp()
+
+def format_time(seconds: float) -> str:
+    return datetime.datetime.fromtimestamp(seconds).strftime(TIMESTAMP_FORMAT)
+
+class TrimHistory:
+    '''
+    An SQLite store of every trim and bias snapshot.
+
+    Every snapshot (a backup, a set, a scan step) is one row of snapshots
+    with its time, kind, source file and free form details, and one row
+    per channel in trims and per board in biases.  The trims and biases
+    are indexed by side, board and channel, and the snapshots by time, so
+    the history of one channel or the state at a given time is an index
+    lookup.
+
+    Parameters:
+        file_name: str - The database.  Defaults to config.HISTORY_DB.
+    '''
+    def __init__(self, file_name: str = None):
+        if file_name is None:
+            file_name = config.HISTORY_DB
+        self.file_name = file_name
+        self.db = sqlite3.connect(file_name, timeout=config.DAEMON_TIMEOUT)
+        # readers are not blocked by the daemon or a scan writing
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        self.db.close()
+
+    @timing.timed('history.record')
+    def record(self, trim_map: TrimMap, kind: str, when: float = None, source: str = None, details: dict = None) -> int:
+        '''
+        Add a snapshot.
+
+        Parameters:
+            trim_map: TrimMap - The trim and board voltages.
+            kind: str - What the snapshot is, e.g. 'backup', 'set' or
+                        'scan_step'.
+            when: float - Seconds since the epoch.  Defaults to now.
+            source: str - Optional file the snapshot comes from.
+            details: dict - Optional information stored as JSON.
+
+        Returns:
+            int - The id of the snapshot.
+        '''
+        if when is None:
+            when = time.time()
+        with self.db:
+            snapshot = self.db.execute('INSERT INTO snapshots (time, kind, source, details) VALUES (?, ?, ?, ?)',
+                                       (when, kind, source, json.dumps(details) if details is not None else None)).lastrowid
+            self.db.executemany('INSERT INTO trims VALUES (?, ?, ?, ?, ?)',
+                                ((snapshot, *TrimMap.location(k), value) for k, value in enumerate(trim_map.trims)))
+            self.db.executemany('INSERT INTO biases VALUES (?, ?, ?, ?)',
+                                ((snapshot, side, ib, value) for (side, ib), value in zip(BOARD_LIST, trim_map.biases)))
+        return snapshot
+
+    def has_source(self, source: str) -> bool:
+        '''
+        Return True if a snapshot was recorded from the file.
+        '''
+        return self.db.execute('SELECT 1 FROM snapshots WHERE source = ? LIMIT 1', (source,)).fetchone() is not None
+
+    def snapshots(self, start: float = None, end: float = None, kind: str = None) -> list:
+        '''
+        Return the snapshots between two times, oldest first.
+
+        Returns:
+            list - A dict with the id, time, kind, source and details of
+                   every snapshot.
+        '''
+        rows = self.db.execute('SELECT id, time, kind, source, details FROM snapshots WHERE time >= ? AND time <= ? AND (? IS NULL OR kind = ?) ORDER BY time, id',
+                               (start if start is not None else float('-inf'), end if end is not None else float('inf'), kind, kind))
+        return [{'id': row[0], 'time': row[1], 'kind': row[2], 'source': row[3], 'details': json.loads(row[4]) if row[4] else None} for row in rows]
+
+    def at(self, when: float, kind: str = None) -> int:
+        '''
+        Return the id of the last snapshot taken at or before a time, or
+        None if there is none.
+        '''
+        row = self.db.execute('SELECT id FROM snapshots WHERE time <= ? AND (? IS NULL OR kind = ?) ORDER BY time DESC, id DESC LIMIT 1',
+                              (when, kind, kind)).fetchone()
+        return row[0] if row else None
+
+    def load(self, snapshot: int) -> TrimMap:
+        '''
+        Return the trim and board voltages of a snapshot.
+        '''
+        trim_map = TrimMap()
+        n_trims = 0
+        for side, ib, channel, value in self.db.execute('SELECT side, ib, channel, value FROM trims WHERE snapshot = ?', (snapshot,)):
+            trim_map[side, ib, channel] = value
+            n_trims += 1
+        if n_trims != N_CHANNELS:
+            raise KeyError(f'Snapshot {snapshot} has {n_trims} trims, expected {N_CHANNELS}')
+        for side, ib, value in self.db.execute('SELECT side, ib, value FROM biases WHERE snapshot = ?', (snapshot,)):
+            trim_map.set_bias(side, ib, value)
+        return trim_map
+
+    def state_at(self, when: float) -> TrimMap:
+        '''
+        Return the trim and board voltages as last recorded at or before a
+        time.
+
+        Raises:
+            KeyError - If nothing was recorded before that time.
+        '''
+        snapshot = self.at(when)
+        if snapshot is None:
+            raise KeyError(f'No snapshot at or before {format_time(when)}')
+        return self.load(snapshot)
+
+    def series(self, side: str, ib: int, channel: int, start: float = None, end: float = None) -> list:
+        '''
+        Return the trim voltage of one channel in every snapshot between two
+        times.
+
+        Returns:
+            list - (time, snapshot id, value) tuples, oldest first.
+        '''
+        return self.db.execute('SELECT s.time, s.id, t.value FROM trims t JOIN snapshots s ON s.id = t.snapshot '
+                               'WHERE t.side = ? AND t.ib = ? AND t.channel = ? AND s.time >= ? AND s.time <= ? ORDER BY s.time, s.id',
+                               (side, ib, channel, start if start is not None else float('-inf'), end if end is not None else float('inf'))).fetchall()
+
+    def bias_series(self, side: str, ib: int, start: float = None, end: float = None) -> list:
+        '''
+        Return the bias voltage of one board in every snapshot between two
+        times.
+
+        Returns:
+            list - (time, snapshot id, value) tuples, oldest first.
+        '''
+        return self.db.execute('SELECT s.time, s.id, b.value FROM biases b JOIN snapshots s ON s.id = b.snapshot '
+                               'WHERE b.side = ? AND b.ib = ? AND s.time >= ? AND s.time <= ? ORDER BY s.time, s.id',
+                               (side, ib, start if start is not None else float('-inf'), end if end is not None else float('inf'))).fetchall()
+
+    def changes(self, side: str, ib: int, channel: int, start: float = None, end: float = None) -> list:
+        '''
+        Return the snapshots where the trim voltage of one channel differs
+        from the snapshot before.
+
+        Returns:
+            list - (time, snapshot id, old value, new value) tuples, oldest
+                   first.
+        '''
+        changes = []
+        previous = None
+        for when, snapshot, value in self.series(side, ib, channel, start, end):
+            if previous is not None and value != previous:
+                changes.append((when, snapshot, previous, value))
+            previous = value
+        return changes
+
+    def diff(self, a: int, b: int) -> dict:
+        '''
+        Compare two snapshots.
+
+        Returns:
+            dict - 'trims': (side, ib, channel, value in a, value in b) of
+                   every differing channel; 'biases': (side, ib, value in a,
+                   value in b) of every differing board.
+        '''
+        trims = self.db.execute('SELECT x.side, x.ib, x.channel, x.value, y.value FROM trims x JOIN trims y '
+                                'ON y.snapshot = ? AND y.side = x.side AND y.ib = x.ib AND y.channel = x.channel '
+                                'WHERE x.snapshot = ? AND x.value != y.value ORDER BY x.side, x.ib, x.channel', (b, a)).fetchall()
+        biases = self.db.execute('SELECT x.side, x.ib, x.value, y.value FROM biases x JOIN biases y '
+                                 'ON y.snapshot = ? AND y.side = x.side AND y.ib = x.ib '
+                                 'WHERE x.snapshot = ? AND x.value != y.value ORDER BY x.side, x.ib', (b, a)).fetchall()
+        return {'trims': trims, 'biases': biases}
+
+def record_snapshot(trim_map: TrimMap, kind: str, when: float = None, source: str = None, details: dict = None) -> int:
+    '''
+    Add a snapshot to the history in config.HISTORY_DB.  Does nothing if
+    config.HISTORY_DB is None or under config.SIMULATE, where nothing is
+    really loaded.  A history that cannot be written is logged
+    and otherwise ignored, so it never stops the bias control.
+
+    Returns:
+        int - The id of the snapshot, or None if it was not recorded.
+    '''
+    if config.HISTORY_DB is None or config.SIMULATE:
+        return None
+    try:
+        with TrimHistory() as history:
+            return history.record(trim_map, kind, when, source, details)
+    except sqlite3.Error as e:
+        logging.warning(f'Could not record the {kind} snapshot in {config.HISTORY_DB}: {e}')
+        return None
+
+def resolve(history: TrimHistory, value: str) -> int:
+    '''
+    Return the snapshot id for a command line value: a timestamp in the
+    format of config.TIMESTAMP, or a snapshot id.
+    '''
+    if len(value) == len(config.TIMESTAMP):
+        return history.at(parse_timestamp(value))
+    return int(value)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Query the history of the sEPD trim and bias voltages')
+    parser.add_argument('--db', metavar='file_name', type=str, default=config.HISTORY_DB, help='History database')
+    parser.add_argument('--list', action='store_true', help='List the snapshots')
+    parser.add_argument('--series', metavar=('side', 'ib', 'channel'), nargs=3, help='Print the trim voltage of a channel in every snapshot')
+    parser.add_argument('--bias', metavar=('side', 'ib'), nargs=2, help='Print the bias voltage of a board in every snapshot')
+    parser.add_argument('--changes', metavar=('side', 'ib', 'channel'), nargs=3, help='Print every change of the trim voltage of a channel')
+    parser.add_argument('--diff', metavar=('a', 'b'), nargs=2, help='Compare two snapshots, given as timestamps (YYYYmmddHHMMSS) or snapshot ids')
+    parser.add_argument('--start', metavar='timestamp', type=str, help='Only use snapshots from this time on')
+    parser.add_argument('--end', metavar='timestamp', type=str, help='Only use snapshots up to this time')
+    parser.add_argument('--log', metavar='log_level', type=str, default='INFO', help='Set the logging level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'])
+    args = parser.parse_args(argv[1:])
+    logging.basicConfig(level=getattr(logging, args.log))
+
+    start = parse_timestamp(args.start) if args.start else None
+    end = parse_timestamp(args.end) if args.end else None
+    with TrimHistory(args.db) as history:
+        if args.list:
+            for snapshot in history.snapshots(start, end):
+                print(snapshot['id'], format_time(snapshot['time']), snapshot['kind'], snapshot['source'] or '', json.dumps(snapshot['details']) if snapshot['details'] else '')
+        if args.series:
+            side, ib, channel = args.series
+            for when, snapshot, value in history.series(side, int(ib), int(channel), start, end):
+                print(format_time(when), snapshot, value)
+        if args.bias:
+            side, ib = args.bias
+            for when, snapshot, value in history.bias_series(side, int(ib), start, end):
+                print(format_time(when), snapshot, value)
+        if args.changes:
+            side, ib, channel = args.changes
+            changes = history.changes(side, int(ib), int(channel), start, end)
+            for when, snapshot, old, new in changes:
+                print(format_time(when), snapshot, old, new)
+            if not changes:
+                logging.info(f'No changes of Side={side}, IB={ib}, I={channel}')
+        if args.diff:
+            a, b = (resolve(history, value) for value in args.diff)
+            if a is None or b is None:
+                logging.error('No snapshot at or before the given time')
+                sys.exit(1)
+            differences = history.diff(a, b)
+            for side, ib, channel, old, new in differences['trims']:
+                print(f'Side={side}, IB={ib}, I={channel}: {old} -> {new}')
+            for side, ib, old, new in differences['biases']:
+                print(f'Side={side}, IB={ib}, Bias: {old} -> {new}')
+            logging.info(f'{len(differences["trims"])} channels and {len(differences["biases"])} boards differ between snapshots {a} and {b}')
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,204 @@
+import array
+import bisect
+
+import config
+
+def layout(controllers: list) -> tuple:
+    '''
+    Number the boards and channels of a list of bias control systems.
+
+    Every controller is a side, named as in config.CONTROLLERS, with its own
+    number of boards and of channels per board.  Boards are numbered by
+    side, then by board; channels by board, then by channel.
+
+    Returns:
+        tuple - The sides, every (side, ib) pair, the flat index of the
+                first board of every side, and the flat index of the first
+                channel of every board followed by the number of channels.
+    '''
+    sides = tuple(controller['name'] for controller in controllers)
+    board_list = []
+    side_offsets = {}
+    board_offsets = [0]
+    for controller in controllers:
+        side_offsets[controller['name']] = len(board_list)
+        for ib in range(controller['boards']):
+            board_list.append((controller['name'], ib))
+            board_offsets.append(board_offsets[-1] + controller['channels'])
+    return (sides, tuple(board_list), side_offsets, tuple(board_offsets))
+
+SIDES, BOARD_LIST, SIDE_OFFSETS, BOARD_OFFSETS = layout(config.CONTROLLERS)
+N_BOARDS = len(BOARD_LIST)
+N_CHANNELS = BOARD_OFFSETS[-1]
+
+# Largest trim voltage magnitude the bias control system accepts
+TRIM_LIMIT = 2500
+
+class TrimMap:
+    '''
+    The trim voltage of every channel and the bias voltage of every board.
+
+    Trims are held in one flat integer array ordered by side, board and
+    channel, and biases in one flat array ordered by side and board (the
+    order generate_bias_map expects).  Comparisons, range checks and
+    serialization work on the whole array at once.
+
+    Parameters:
+        trims: iterable - Optional trim voltages, N_CHANNELS long.
+        biases: iterable - Optional board bias voltages, N_BOARDS long.
+    '''
+    def __init__(self, trims=None, biases=None):
+        self.trims = array.array('i', trims if trims is not None else [0] * N_CHANNELS)
+        self.biases = array.array('d', biases if biases is not None else [0.0] * N_BOARDS)
+        if len(self.trims) != N_CHANNELS or len(self.biases) != N_BOARDS:
+            raise ValueError(f'TrimMap needs {N_CHANNELS} trims and {N_BOARDS} biases, got {len(self.trims)} and {len(self.biases)}')
+
+    @staticmethod
+    def board_index(side: str, ib: int) -> int:
+        '''
+        Return the flat index of a board.
+        '''
+        return SIDE_OFFSETS[side] + ib
+
+    @staticmethod
+    def index(side: str, ib: int, channel: int) -> int:
+        '''
+        Return the flat index of a channel.
+        '''
+        return BOARD_OFFSETS[SIDE_OFFSETS[side] + ib] + channel
+
+    @staticmethod
+    def board_of(index: int) -> int:
+        '''
+        Return the flat index of the board holding a flat channel index.
+        '''
+        return bisect.bisect_right(BOARD_OFFSETS, index) - 1
+
+    @staticmethod
+    def location(index: int) -> tuple:
+        '''
+        Return the (side, ib, channel) of a flat channel index.
+        '''
+        board = bisect.bisect_right(BOARD_OFFSETS, index) - 1
+        side, ib = BOARD_LIST[board]
+        return (side, ib, index - BOARD_OFFSETS[board])
+
+    @staticmethod
+    def valid(side: str, ib: int, channel: int = 0) -> bool:
+        '''
+        Return True if the side, board and channel exist.
+        '''
+        if side not in SIDE_OFFSETS or ib < 0 or channel < 0:
+            return False
+        board = SIDE_OFFSETS[side] + ib
+        return board < N_BOARDS and BOARD_LIST[board][0] == side and BOARD_OFFSETS[board] + channel < BOARD_OFFSETS[board + 1]
+
+    @staticmethod
+    def boards() -> list:
+        '''
+        Return every (side, ib) pair in flat order.
+        '''
+        return list(BOARD_LIST)
+
+    @staticmethod
+    def board_slice(board: int) -> slice:
+        '''
+        Return the slice of the flat channel indices of a board.
+        '''
+        return slice(BOARD_OFFSETS[board], BOARD_OFFSETS[board + 1])
+
+    @staticmethod
+    def channels(side: str, ib: int) -> int:
+        '''
+        Return the number of channels of a board.
+        '''
+        board = SIDE_OFFSETS[side] + ib
+        return BOARD_OFFSETS[board + 1] - BOARD_OFFSETS[board]
+
+    def __getitem__(self, key: tuple) -> int:
+        return self.trims[self.index(*key)]
+
+    def __setitem__(self, key: tuple, value: int) -> None:
+        self.trims[self.index(*key)] = value
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, TrimMap):
+            return NotImplemented
+        return self.trims == other.trims and self.biases == other.biases
+
+    def copy(self) -> 'TrimMap':
+        return TrimMap(self.trims, self.biases)
+
+    def board(self, side: str, ib: int) -> array.array:
+        '''
+        Return the trims of one board.
+        '''
+        return self.trims[self.board_slice(self.board_index(side, ib))]
+
+    def set_board(self, side: str, ib: int, values) -> None:
+        '''
+        Replace the trims of one board.
+        '''
+        self.trims[self.board_slice(self.board_index(side, ib))] = array.array('i', values)
+
+    def bias(self, side: str, ib: int) -> float:
+        return self.biases[self.board_index(side, ib)]
+
+    def set_bias(self, side: str, ib: int, value: float) -> None:
+        self.biases[self.board_index(side, ib)] = value
+
+    def set_biases(self, value: float) -> None:
+        '''
+        Set every board to the same bias voltage.
+        '''
+        self.biases = array.array('d', [value] * N_BOARDS)
+
+    def out_of_range(self, limit: int = TRIM_LIMIT) -> list:
+        '''
+        Return the flat indices of trims whose magnitude exceeds the limit.
+        '''
+        return [k for k, v in enumerate(self.trims) if v > limit or v < -limit]
+
+    def clipped(self, limit: int = TRIM_LIMIT) -> 'TrimMap':
+        '''
+        Return a copy with every out of range trim replaced by 0.
+        '''
+        return TrimMap([0 if v > limit or v < -limit else v for v in self.trims], self.biases)
+
+    def diff(self, other: 'TrimMap', boards: list = None) -> list:
+        '''
+        Return the flat indices of channels whose trims differ.
+
+        Parameters:
+            other: TrimMap - The trims to compare to.
+            boards: list - Optional (side, ib) pairs to restrict the
+                           comparison to.
+
+        Returns:
+            list - The flat indices of the differing channels.
+        '''
+        if boards is None:
+            return [k for k, (a, b) in enumerate(zip(self.trims, other.trims)) if a != b]
+        changed = []
+        for side, ib in boards:
+            board = self.board_slice(self.board_index(side, ib))
+            changed.extend(board.start + i for i, (a, b) in enumerate(zip(self.trims[board], other.trims[board])) if a != b)
+        return changed
+
+    def tobytes(self) -> bytes:
+        '''
+        Serialize the trims followed by the biases in native byte order.
+        '''
+        return self.trims.tobytes() + self.biases.tobytes()
+
+    @classmethod
+    def frombytes(cls, data: bytes) -> 'TrimMap':
+        '''
+        Build a TrimMap from the output of tobytes.
+        '''
+        n_trims = N_CHANNELS * array.array('i').itemsize
+        trims = array.array('i')
+        trims.frombytes(data[:n_trims])
+        biases = array.array('d')
+        biases.frombytes(data[n_trims:])
+        return cls(trims, biases)
@@ -0,0 +1,86 @@
+import array
+
+import config
+from trim_map import TrimMap, N_BOARDS
+
+def board_rates(controllers: list = None) -> list:
+    '''
+    Return the ramp rate of every board in flat order, in counts per second.
+    A controller entry can set its own 'ramp_rate', the others use
+    config.RAMP_RATE.
+    '''
+    if controllers is None:
+        controllers = config.CONTROLLERS
+    rates = []
+    for controller in controllers:
+        rates.extend([controller.get('ramp_rate', config.RAMP_RATE)] * controller['boards'])
+    return rates
+
+def board_steps(current: array.array, target: array.array, max_step: int) -> list:
+    '''
+    Split the change of the trims of one board into steps.
+
+    Every channel moves towards its target by at most max_step per step,
+    so channels with small changes arrive first.
+
+    Returns:
+        list - The trims after each step, with the largest change of any
+               channel in that step.
+    '''
+    deltas = [b - a for a, b in zip(current, target)]
+    n_steps = -(-max((abs(d) for d in deltas), default=0) // max_step)
+    steps = []
+    previous = current
+    for k in range(1, n_steps + 1):
+        limit = k * max_step
+        values = array.array('i', (a + max(-limit, min(limit, d)) for a, d in zip(current, deltas)))
+        steps.append((values, max(abs(b - a) for a, b in zip(previous, values))))
+        previous = values
+    return steps
+
+def ramp_schedule(current: TrimMap, target: TrimMap, max_step: int = None, rates: list = None) -> list:
+    '''
+    Plan a ramp of the trims from one set of values to another.
+
+    Each board goes through its own steps (see board_steps), and a step of
+    size s follows the previous step of that board by s / rate seconds.
+    The first step of every board goes out at once.  Steps of different
+    boards due at the same time form one stage, applied to every side in
+    parallel, so the ramp takes as long as its slowest board.
+
+    Parameters:
+        current: TrimMap - The trims loaded now.
+        target: TrimMap - The trims to ramp to, already in range.
+        max_step: int - Largest change of a channel per step.  Defaults to
+                        config.RAMP_STEP.
+        rates: list - The rate of every board in counts per second.
+                      Defaults to board_rates().
+
+    Returns:
+        list - (seconds from the start, TrimMap) of every stage, in order.
+               The last stage holds the target trims.
+    '''
+    if max_step is None:
+        max_step = config.RAMP_STEP
+    if rates is None:
+        rates = board_rates()
+
+    # time of every step of every board, as (time, board, values)
+    events = []
+    for board in range(N_BOARDS):
+        board_slice = TrimMap.board_slice(board)
+        t = 0.0
+        for n, (values, size) in enumerate(board_steps(current.trims[board_slice], target.trims[board_slice], max_step)):
+            if n:
+                t += size / rates[board]
+            events.append((round(t, 6), board, values))
+    events.sort(key=lambda event: event[:2])
+
+    stages = []
+    trim_map = TrimMap(current.trims, target.biases)
+    for t, board, values in events:
+        if not stages or stages[-1][0] != t:
+            trim_map = trim_map.copy()
+            stages.append((t, trim_map))
+        trim_map.trims[TrimMap.board_slice(board)] = values
+    return stages
@@ -0,0 +1,152 @@
+import array
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+
+import timing
+from bias_map import write_atomic
+from trim_map import TrimMap, N_BOARDS, N_CHANNELS
+
+SNAPSHOT_EXTENSION = '.snap'
+SNAPSHOT_MAGIC = b'SEPDTRIM'
+SNAPSHOT_VERSION = 1
+
+# Header: magic, version, number of channels, number of boards, timestamp
+# (seconds since the epoch), crc32 of the payload, padding to 32 bytes.
+# The payload follows: the trims as little endian int32, then the board
+# biases as little endian float64.  All fields are at fixed offsets.
+HEADER = struct.Struct('<8sIHHdI4x')
+TRIMS_OFFSET = HEADER.size
+BIASES_OFFSET = TRIMS_OFFSET + 4 * N_CHANNELS
+SNAPSHOT_SIZE = BIASES_OFFSET + 8 * N_BOARDS
+
+class SnapshotError(Exception):
+    '''
+    Raised when a snapshot file is malformed or fails its checksum.
+    '''
+    pass
+
+def is_snapshot(file_name: str) -> bool:
+    '''
+    Return True if the file is a binary trim snapshot.
+    '''
+    if file_name.endswith(SNAPSHOT_EXTENSION):
+        return True
+    try:
+        with open(file_name, 'rb') as f:
+            return f.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+    except OSError:
+        return False
+
+def snapshot_bytes(trim_map: TrimMap, timestamp: float = None) -> bytes:
+    '''
+    Serialize a TrimMap into the snapshot layout.
+
+    Parameters:
+        trim_map: TrimMap - The trim and board voltages.
+        timestamp: float - Seconds since the epoch.  Defaults to now.
+
+    Returns:
+        bytes - The snapshot.
+    '''
+    if timestamp is None:
+        timestamp = time.time()
+    trims = array.array('i', trim_map.trims)
+    biases = array.array('d', trim_map.biases)
+    if sys.byteorder == 'big':
+        trims.byteswap()
+        biases.byteswap()
+    payload = trims.tobytes() + biases.tobytes()
+    return HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, N_CHANNELS, N_BOARDS, timestamp, zlib.crc32(payload)) + payload
+
+@timing.timed('file.snapshot_write')
+def write_snapshot(file_name: str, trim_map: TrimMap, timestamp: float = None) -> None:
+    '''
+    Write a snapshot file.  The file is replaced atomically.
+
+    Parameters:
+        file_name: str - The snapshot file.
+        trim_map: TrimMap - The trim and board voltages.
+        timestamp: float - Seconds since the epoch.  Defaults to now.
+
+    Returns:
+        None
+    '''
+    write_atomic(file_name, snapshot_bytes(trim_map, timestamp))
+
+class Snapshot:
+    '''
+    A memory-mapped snapshot file.  trims and biases are views into the
+    mapping, so nothing is copied until they are used.  The views are in
+    file (little endian) byte order; use to_trim_map on big endian machines.
+
+    Parameters:
+        file_name: str - The snapshot file.
+        verify: bool - If True, check the checksum when opening.
+    '''
+    def __init__(self, file_name: str, verify: bool = True):
+        self.file_name = file_name
+        with open(file_name, 'rb') as f:
+            if os.fstat(f.fileno()).st_size != SNAPSHOT_SIZE:
+                raise SnapshotError(f'{file_name}: expected {SNAPSHOT_SIZE} bytes')
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_channels, n_boards, self.timestamp, self.crc = HEADER.unpack_from(self.mmap)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            self.close()
+            raise SnapshotError(f'{file_name}: not a version {SNAPSHOT_VERSION} trim snapshot')
+        if n_channels != N_CHANNELS or n_boards != N_BOARDS:
+            self.close()
+            raise SnapshotError(f'{file_name}: snapshot holds {n_channels} channels and {n_boards} boards')
+        if verify and not self.verify():
+            self.close()
+            raise SnapshotError(f'{file_name}: checksum mismatch')
+        with memoryview(self.mmap) as view:
+            self.trims = view[TRIMS_OFFSET:BIASES_OFFSET].cast('i')
+            self.biases = view[BIASES_OFFSET:SNAPSHOT_SIZE].cast('d')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def verify(self) -> bool:
+        '''
+        Return True if the payload matches the checksum in the header.
+        '''
+        with memoryview(self.mmap) as view:
+            return zlib.crc32(view[TRIMS_OFFSET:]) == self.crc
+
+    def to_trim_map(self) -> TrimMap:
+        '''
+        Copy the snapshot into a TrimMap.
+        '''
+        trims = array.array('i', self.trims)
+        biases = array.array('d', self.biases)
+        if sys.byteorder == 'big':
+            trims.byteswap()
+            biases.byteswap()
+        return TrimMap(trims, biases)
+
+    def close(self) -> None:
+        for view in ('trims', 'biases'):
+            if hasattr(self, view):
+                getattr(self, view).release()
+                delattr(self, view)
+        self.mmap.close()
+
+def read_snapshot(file_name: str) -> tuple:
+    '''
+    Read a snapshot file.
+
+    Parameters:
+        file_name: str - The snapshot file.
+
+    Returns:
+        tuple - The TrimMap and the timestamp of the snapshot.
+    '''
+    with Snapshot(file_name) as snapshot:
+        return (snapshot.to_trim_map(), snapshot.timestamp)